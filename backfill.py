@@ -1,11 +1,13 @@
+import argparse
 import random
-from datetime import date, datetime, timedelta
-
-import arrow
-
-from src import db, dal, utils
-from src.catalogs import OrderContext
-from src.db import Database
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+
+from src import dal, utils
+from src.catalogs import OrderContext, ReferenceData
+from src.shifts import ShiftRegistry
+from src.db import Database, create_dsn, get_pool
 from src.utils import croak
 
 config = utils.get_config()
@@ -15,6 +17,9 @@ BARRIER = int(config["barrier"]["daily"])
 BARRIER_JITTER = int(config["barrier"]["jitter"])
 START_HOURS = int(config["main"]["business_hours"]["start"])
 END_HOURS = int(config["main"]["business_hours"]["end"])
+WORKERS = int(config.get("backfill", {}).get("workers", 4))
+COMMIT_BATCH = int(config.get("backfill", {}).get("commit_batch", 50))
+REFS = ReferenceData()
 
 
 def get_rand_hwm() -> int:
@@ -22,13 +27,9 @@ def get_rand_hwm() -> int:
 
 
 def purge_orders(dt: date):
-    with db.Database.make(DB_DEST) as db_:
-        invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt}")
-
-        for ord in invoices:
-            croak(f"Purging #{ord.InvoiceId} - {ord.OrderId}")
-            dal.purge_order_chain(ord.InvoiceId, db_)
+    with Database.pooled(DB_DEST) as db_:
+        purged = dal.purge_chains(dt, dt, db_, progress=utils.report_purge)
+        croak(f"Purged {purged} invoices for {dt}")
 
         croak(f"Purging work shifts")
         dal.purge_work_shifts(dt, db_)
@@ -37,15 +38,9 @@ def purge_orders(dt: date):
 def recreate_shifts(
     orders: list[OrderContext], dt: date, db_: Database
 ) -> dict[int, int]:
-    user_ids = set([x.order.OrderingUserId for x in orders])
-    shift_map = {}
-
-    for uid in user_ids:
-        shift_id = dal.find_shift(uid, dt, db_)
-        if not shift_id:
-            shift_id = dal.create_shift(uid, dt, db_)
-        if shift_id:
-            shift_map[uid] = shift_id
+    # one query for the day's shifts, one batched INSERT for the missing ones
+    user_ids = [x.order.OrderingUserId for x in orders]
+    shift_map = ShiftRegistry().ensure(user_ids, dt, db_)
 
     """
     for ord in orders:
@@ -69,28 +64,31 @@ def recreate_shifts(
 
 
 def src_scan_orders(dt: date, max_net: int) -> list[OrderContext]:
-    net_total = 0
-    with db.Database.make(DB_SRC) as db_:
-        test_cat = dal.get_test_catalog(db_)
-        invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt} | HWM: {max_net:,.0f}")
+    with Database.pooled(DB_SRC) as db_:
+        REFS.refresh(db_)
+        test_cat = REFS.active_tests
+        croak(f"Pricing invoices for {dt} | HWM: {max_net:,.0f}")
+
+        nets = dal.invoice_nets(dt, db_)
+        cutoff, net_total = utils.choose_cutoff(nets, max_net)
+        croak(
+            f"Keeping invoices up to #{cutoff} of {len(nets)} | Net: {net_total:,.0f}"
+        )
 
         contexts = []
-        for i, inv in enumerate(invoices):
-            croak(
-                f"{i:04d} Scanning #{inv.InvoiceId} {inv.OrderId} | Net: {net_total:,.0f}"
+        if cutoff is not None:
+            pages = dal.iter_invoice_pages(
+                dt, db_, referrers=REFS.referrers, until_id=cutoff
             )
-            ctx = OrderContext(inv)
-            ctx.scan(db_)
-            net_total += ctx.master.NetPayable
-            if net_total >= max_net:
-                croak(
-                    f"Filtered {len(contexts)} orders | HWM: {max_net} | Actual: {net_total}"
-                )
-                break
-
-            ctx.sanitize_tests(test_cat)
-            contexts.append(ctx)
+            for page in pages:
+                for ctx in OrderContext.scan_all(page, db_, REFS):
+                    croak(
+                        f"{len(contexts):04d} Scanning #{ctx.order.InvoiceId} {ctx.order.OrderId}"
+                    )
+                    ctx.sanitize_tests(test_cat)
+                    contexts.append(ctx)
+
+        croak(f"Filtered {len(contexts)} orders | HWM: {max_net} | Actual: {net_total}")
 
     croak(f"Time-spreading {len(contexts)} orders")
     time_spread_invoices(contexts, dt)
@@ -98,22 +96,25 @@ def src_scan_orders(dt: date, max_net: int) -> list[OrderContext]:
     return contexts
 
 
-def insert_lab_order_chain(ctx: OrderContext, shift_map: dict[int, int], db_: Database):
+def insert_lab_order_chain(
+    ctx: OrderContext, shift_map: dict[int, int], db_: Database
+) -> int | None:
     croak(f"INSERT #{ctx.order.InvoiceId} - {ctx.order.OrderId}")
     shift_id = shift_map.get(ctx.order.OrderingUserId)
     ctx.order.WorkShiftId = shift_id
-    if not dal.insert_order(ctx.order, db_):
-        return
+    with db_.transaction():
+        invoice_id = dal.insert_order(ctx.order, db_)
+        if not invoice_id:
+            return None
 
-    invoice_id = dal.shadow_id_for_source_id(ctx.order.InvoiceId, db_)
-    croak(f"Src: {ctx.order.InvoiceId} -> Dest: {invoice_id}")
-    dal.insert_master(invoice_id, ctx.master, db_)
-    dal.insert_primal(invoice_id, ctx.primal, db_)
-    dal.insert_transactions(invoice_id, ctx.transactions, shift_id, db_)
-    dal.insert_items(invoice_id, ctx.items, db_)
-    dal.insert_tests(invoice_id, ctx.tests, db_)
-    dal.insert_bundles(invoice_id, ctx.bundles, db_)
-    db_.commit()
+        croak(f"Src: {ctx.order.InvoiceId} -> Dest: {invoice_id}")
+        dal.insert_master(invoice_id, ctx.master, db_)
+        dal.insert_primal(invoice_id, ctx.primal, db_)
+        dal.insert_transactions(invoice_id, ctx.transactions, shift_id, db_)
+        dal.insert_items(invoice_id, ctx.items, db_)
+        bundle_ids = dal.insert_bundles(invoice_id, ctx.bundles, db_)
+        dal.insert_tests(invoice_id, ctx.tests, db_, bundle_ids)
+    return invoice_id
 
 
 def filter_orders(orders: list[OrderContext], barrier: int) -> list[OrderContext]:
@@ -129,43 +130,80 @@ def filter_orders(orders: list[OrderContext], barrier: int) -> list[OrderContext
 
 
 def reconcile_shifts(shift_map: dict[int, int], db_: Database):
-    croak(f"Found {len(shift_map.keys())} shifts")
-    for uid in shift_map.keys():
-        croak(f"Reconciling shift #{shift_map[uid]}")
-        dal.reconcile_shift(shift_map[uid], True, db_)
+    croak(f"Reconciling {len(shift_map.keys())} shifts")
+    dal.reconcile_shifts(list(shift_map.values()), True, db_)
 
 
 def time_spread_invoices(orders: list[OrderContext], dt: date):
-    sod = datetime.combine(dt, datetime.min.time()) + timedelta(
-        hours=START_HOURS, minutes=random.randint(3, 12)
-    )
-    eod = datetime.combine(dt, datetime.min.time()) + timedelta(
-        hours=END_HOURS - 1, minutes=random.randint(45, 57)
-    )
-    total_seconds = (eod - sod).total_seconds()
-    interval = total_seconds / len(orders)
-
-    for i, ord in enumerate(orders):
-        ord.order.OrderDateTime = sod + timedelta(seconds=i * interval)
+    times = utils.spread_times(dt, len(orders), START_HOURS, END_HOURS)
+    for ord, order_time in zip(orders, times):
+        ord.order.OrderDateTime = order_time
 
 
 def populate_shadow(orders: list[OrderContext], dt: date):
-    with db.Database.make(DB_DEST) as db_:
+    with Database.pooled(DB_DEST) as db_:
+        # one query for everything already replicated, instead of finding
+        # out chain by chain
+        replicated = dal.replicated_ids(dt, dt, db_)
         shift_map = recreate_shifts(orders, dt, db_)
+        pending = []
         for ord in orders:
-            insert_lab_order_chain(ord, shift_map, db_)
+            if ord.order.InvoiceId in replicated:
+                croak(f"Skipping #{ord.order.InvoiceId}. already exists")
+                continue
+            pending.append(ord)
+
+        # a batch of chains commits at once, each chain a savepoint inside it;
+        # no transaction holds its locks for the whole day
+        for i in range(0, len(pending), COMMIT_BATCH):
+            with db_.transaction():
+                for ord in pending[i : i + COMMIT_BATCH]:
+                    if insert_lab_order_chain(ord, shift_map, db_):
+                        replicated.add(ord.order.InvoiceId)
 
         reconcile_shifts(shift_map, db_)
 
 
+def backfill_day(dt: date):
+    croak(f"Backfilling {dt}")
+    purge_orders(dt)
+    barrier = get_rand_hwm()
+    orders = src_scan_orders(dt, barrier)
+    populate_shadow(orders, dt)
+    return dt
+
+
+def backfill(start: date, end: date, workers: int) -> list[date]:
+    # every worker borrows its own source and destination connection, so the
+    # pools are sized to the concurrency cap and nothing more
+    get_pool(create_dsn(DB_SRC), max_size=workers)
+    get_pool(create_dsn(DB_DEST), max_size=workers)
+
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(backfill_day, dt): dt for dt in days}
+        for future in as_completed(futures):
+            dt = futures[future]
+            try:
+                future.result()
+                croak(f"Done {dt}")
+            except Exception as e:
+                croak(f"FAILED {dt}: {e!r}")
+                failed.append(dt)
+    return sorted(failed)
+
+
 if __name__ == "__main__":
-    start_date = arrow.get("2024-12-11")
-    end_date = arrow.get("2024-12-19")
-    dt = start_date
-
-    while dt <= end_date:
-        purge_orders(dt)
-        barrier = get_rand_hwm()
-        orders = src_scan_orders(dt, barrier)
-        populate_shadow(orders, dt)
-        dt = dt.shift(days=1)
+    parser = argparse.ArgumentParser(description="Re-seed shadow data for a range")
+    parser.add_argument("start", type=date.fromisoformat, help="first day (ISO)")
+    parser.add_argument("end", type=date.fromisoformat, help="last day (ISO)")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=WORKERS, help="days processed at once"
+    )
+    args = parser.parse_args()
+
+    failed = backfill(args.start, args.end, max(1, args.workers))
+    if failed:
+        croak(f"{len(failed)} day(s) failed: {', '.join(map(str, failed))}")
+        sys.exit(1)
@@ -0,0 +1,81 @@
+import decimal
+import time
+from datetime import datetime
+
+from src import models, rows
+
+N = 50_000
+NOW = datetime(2024, 12, 11, 9, 30)
+
+# (column, pyodbc type code, sample value) as PROE.OrderedTests + joins returns them
+TEST_COLUMNS = [
+    ("Id", int, 1),
+    ("InvoiceId", int, 1000),
+    ("LabTestId", int, 42),
+    ("ResultBundleId", int, None),
+    ("IsCancelled", bool, False),
+    ("UnitPrice", decimal.Decimal, decimal.Decimal("850.0000")),
+    ("WorkflowStage", int, 3),
+    ("DateCreated", datetime, NOW),
+    ("LastModified", datetime, NOW),
+    ("ResultsETA", datetime, None),
+    ("LabNo", str, None),
+    ("TestName", str, "CBC"),
+    ("LabId", int, 7),
+]
+
+TX_COLUMNS = [
+    ("Id", int, 1),
+    ("InvoiceId", int, 1000),
+    ("PerformingUserId", int, 12),
+    ("WorkShiftId", int, 55),
+    ("AuthorizingUserId", int, None),
+    ("TxTime", datetime, NOW),
+    ("TxType", int, 10),
+    ("TxFlag", int, 0),
+    ("TxAmount", decimal.Decimal, decimal.Decimal("1200.0000")),
+    ("UserIpAddress", int, None),
+    ("UserRemarks", str, None),
+    ("NonCashAmount", decimal.Decimal, decimal.Decimal("0.0000")),
+    ("PaymentMethod", int, 0),
+]
+
+
+def make_rows(columns: list[tuple]) -> tuple[tuple, list[tuple]]:
+    description = tuple((c[0], c[1], None, None, None, None, True) for c in columns)
+    data = []
+    for i in range(N):
+        row = [c[2] for c in columns]
+        row[0] = i
+        data.append(tuple(row))
+    return description, data
+
+
+def baseline(model, description, data) -> list:
+    # what Database.fetch_all + models.X(**row) used to do
+    cols = [c[0] for c in description]
+    dicts = list(map(lambda o: dict(zip(cols, o)), data))
+    return [model(**row) for row in dicts]
+
+
+def factory(model, description, data) -> list:
+    make = rows.factory_for(model, description)
+    return list(map(make, data))
+
+
+def bench(label: str, fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<40} {N / elapsed:>12,.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    for model, columns in [
+        (models.OrderedLabTest, TEST_COLUMNS),
+        (models.InvoiceTransaction, TX_COLUMNS),
+    ]:
+        description, data = make_rows(columns)
+        print(model.__name__)
+        bench("  dict(zip) + model(**row)", baseline, model, description, data)
+        bench("  RowFactory (trusted)", factory, model, description, data)
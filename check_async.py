@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+
+from src.db import AsyncDatabase, Database
+
+# stand-in for a SQL Server connection: checks how AsyncDatabase drives one
+# without a server. Run with `python check_async.py`.
+
+
+class FakeCursor:
+    def __init__(self, conn: "FakeConnection"):
+        self.conn = conn
+        self.description = None
+        self.rowcount = -1
+        self.fast_executemany = False
+        self._rows = []
+
+    def execute(self, sql: str, params=()):
+        self.conn.record(sql, params)
+        self.description = (("value", int, None, None, None, None, True),)
+        self._rows = [(p,) for p in params]
+        self.rowcount = len(self._rows)
+        return self
+
+    def executemany(self, sql: str, params: list[tuple]):
+        for p in params:
+            self.conn.record(sql, p)
+        self.rowcount = len(params)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size: int):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchval(self):
+        row = self.fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, delay: float = 0.002):
+        self.delay = delay
+        self.autocommit = False
+        self.closed = False
+        self.log: list[str] = []
+        self.threads: set[str] = set()
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, params=()):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.threads.add(threading.current_thread().name)
+        # long enough for a second thread to overlap, if one could
+        time.sleep(self.delay)
+        with self._lock:
+            self.log.append(sql)
+            self.active -= 1
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def execute(self, sql: str, *params):
+        return self.cursor().execute(sql, params)
+
+    def commit(self):
+        self.record("<commit>")
+
+    def rollback(self):
+        self.record("<rollback>")
+
+    def close(self):
+        self.closed = True
+
+
+def fake_adb(autocommit: bool = True) -> tuple[AsyncDatabase, FakeConnection]:
+    db = Database("fake", autocommit=autocommit)
+    db._conn = FakeConnection()
+    return AsyncDatabase(db), db._conn
+
+
+async def check_serialised():
+    adb, conn = fake_adb()
+    values = await asyncio.gather(*(adb.fetch_val("SELECT ?", i) for i in range(20)))
+    await adb.close()
+    assert values == list(range(20)), values
+    assert conn.max_active == 1, f"{conn.max_active} statements overlapped"
+    assert len(conn.threads) == 1, conn.threads
+
+
+async def check_commit():
+    adb, conn = fake_adb()
+    async with adb.transaction():
+        await adb.execute("UPDATE a")
+        await adb.execute("UPDATE b")
+    await adb.close()
+    assert conn.log == [
+        "<commit>",
+        "BEGIN TRANSACTION",
+        "UPDATE a",
+        "UPDATE b",
+        "COMMIT TRANSACTION",
+    ], conn.log
+    assert conn.autocommit is False
+
+
+async def check_rollback():
+    adb, conn = fake_adb()
+    try:
+        async with adb.transaction():
+            await adb.execute("UPDATE a")
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("the error was swallowed")
+    await adb.close()
+    assert "IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION" in conn.log, conn.log
+    assert "COMMIT TRANSACTION" not in conn.log, conn.log
+    assert conn.autocommit is False
+
+
+async def check_savepoint():
+    adb, conn = fake_adb()
+    async with adb.transaction():
+        await adb.execute("UPDATE a")
+        try:
+            async with adb.transaction():
+                await adb.execute("UPDATE b")
+                raise RuntimeError("boom")
+        except RuntimeError:
+            pass
+    await adb.close()
+    assert conn.log[-3:] == [
+        "UPDATE b",
+        "IF XACT_STATE() = 1 ROLLBACK TRANSACTION sp1",
+        "COMMIT TRANSACTION",
+    ], conn.log
+
+
+async def check_manual_commit():
+    adb, conn = fake_adb(autocommit=False)
+    await adb.execute("UPDATE a")
+    assert "<commit>" not in conn.log, conn.log
+    await adb.run(adb.db.commit)
+    await adb.close()
+    assert conn.log == ["UPDATE a", "<commit>"], conn.log
+
+
+async def main():
+    for check in [
+        check_serialised,
+        check_commit,
+        check_rollback,
+        check_savepoint,
+        check_manual_commit,
+    ]:
+        await check()
+        print(f"{check.__name__:<24} ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
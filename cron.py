@@ -1,10 +1,11 @@
 import random
-from datetime import date, datetime, timedelta
+from datetime import date
 
 import arrow
 
-from src import db, dal, utils
-from src.catalogs import OrderContext
+from src import dal, utils
+from src.catalogs import OrderContext, ReferenceData
+from src.shifts import ShiftRegistry
 from src.db import Database
 from src.utils import croak
 
@@ -15,6 +16,7 @@ BARRIER = int(config["barrier"]["daily"])
 BARRIER_JITTER = int(config["barrier"]["jitter"])
 START_HOURS = int(config["main"]["business_hours"]["start"])
 END_HOURS = int(config["main"]["business_hours"]["end"])
+REFS = ReferenceData()
 
 
 def get_rand_hwm() -> int:
@@ -22,13 +24,9 @@ def get_rand_hwm() -> int:
 
 
 def purge_orders(dt: date):
-    with db.Database.make(DB_DEST) as db_:
-        invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt}")
-
-        for ord in invoices:
-            croak(f"Purging #{ord.InvoiceId} - {ord.OrderId}")
-            dal.purge_order_chain(ord.InvoiceId, db_)
+    with Database.pooled(DB_DEST) as db_:
+        purged = dal.purge_chains(dt, dt, db_, progress=utils.report_purge)
+        croak(f"Purged {purged} invoices for {dt}")
 
         croak(f"Purging work shifts")
         dal.purge_work_shifts(dt, db_)
@@ -37,15 +35,9 @@ def purge_orders(dt: date):
 def recreate_shifts(
     orders: list[OrderContext], dt: date, db_: Database
 ) -> dict[int, int]:
-    user_ids = set([x.order.OrderingUserId for x in orders])
-    shift_map = {}
-
-    for uid in user_ids:
-        shift_id = dal.find_shift(uid, dt, db_)
-        if not shift_id:
-            shift_id = dal.create_shift(uid, dt, db_)
-        if shift_id:
-            shift_map[uid] = shift_id
+    # one query for the day's shifts, one batched INSERT for the missing ones
+    user_ids = [x.order.OrderingUserId for x in orders]
+    shift_map = ShiftRegistry().ensure(user_ids, dt, db_)
 
     """
     for ord in orders:
@@ -69,28 +61,31 @@ def recreate_shifts(
 
 
 def src_scan_orders(dt: date, max_net: int) -> list[OrderContext]:
-    net_total = 0
-    with db.Database.make(DB_SRC) as db_:
-        test_cat = dal.get_test_catalog(db_)
-        invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt} | HWM: {max_net:,.0f}")
+    with Database.pooled(DB_SRC) as db_:
+        REFS.refresh(db_)
+        test_cat = REFS.active_tests
+        croak(f"Pricing invoices for {dt} | HWM: {max_net:,.0f}")
+
+        nets = dal.invoice_nets(dt, db_)
+        cutoff, net_total = utils.choose_cutoff(nets, max_net)
+        croak(
+            f"Keeping invoices up to #{cutoff} of {len(nets)} | Net: {net_total:,.0f}"
+        )
 
         contexts = []
-        for i, inv in enumerate(invoices):
-            croak(
-                f"{i:04d} Scanning #{inv.InvoiceId} {inv.OrderId} | Net: {net_total:,.0f}"
+        if cutoff is not None:
+            pages = dal.iter_invoice_pages(
+                dt, db_, referrers=REFS.referrers, until_id=cutoff
             )
-            ctx = OrderContext(inv)
-            ctx.scan(db_)
-            net_total += ctx.master.NetPayable
-            if net_total >= max_net:
-                croak(
-                    f"Filtered {len(contexts)} orders | HWM: {max_net} | Actual: {net_total}"
-                )
-                break
-
-            ctx.sanitize_tests(test_cat)
-            contexts.append(ctx)
+            for page in pages:
+                for ctx in OrderContext.scan_all(page, db_, REFS):
+                    croak(
+                        f"{len(contexts):04d} Scanning #{ctx.order.InvoiceId} {ctx.order.OrderId}"
+                    )
+                    ctx.sanitize_tests(test_cat)
+                    contexts.append(ctx)
+
+        croak(f"Filtered {len(contexts)} orders | HWM: {max_net} | Actual: {net_total}")
 
     croak(f"Time-spreading {len(contexts)} orders")
     time_spread_invoices(contexts, dt)
@@ -98,22 +93,25 @@ def src_scan_orders(dt: date, max_net: int) -> list[OrderContext]:
     return contexts
 
 
-def insert_lab_order_chain(ctx: OrderContext, shift_map: dict[int, int], db_: Database):
+def insert_lab_order_chain(
+    ctx: OrderContext, shift_map: dict[int, int], db_: Database
+) -> int | None:
     croak(f"INSERT #{ctx.order.InvoiceId} - {ctx.order.OrderId}")
     shift_id = shift_map.get(ctx.order.OrderingUserId)
     ctx.order.WorkShiftId = shift_id
-    if not dal.insert_order(ctx.order, db_):
-        return
+    with db_.transaction():
+        invoice_id = dal.insert_order(ctx.order, db_)
+        if not invoice_id:
+            return None
 
-    invoice_id = dal.shadow_id_for_source_id(ctx.order.InvoiceId, db_)
-    croak(f"Src: {ctx.order.InvoiceId} -> Dest: {invoice_id}")
-    dal.insert_master(invoice_id, ctx.master, db_)
-    dal.insert_primal(invoice_id, ctx.primal, db_)
-    dal.insert_transactions(invoice_id, ctx.transactions, shift_id, db_)
-    dal.insert_items(invoice_id, ctx.items, db_)
-    dal.insert_tests(invoice_id, ctx.tests, db_)
-    dal.insert_bundles(invoice_id, ctx.bundles, db_)
-    db_.commit()
+        croak(f"Src: {ctx.order.InvoiceId} -> Dest: {invoice_id}")
+        dal.insert_master(invoice_id, ctx.master, db_)
+        dal.insert_primal(invoice_id, ctx.primal, db_)
+        dal.insert_transactions(invoice_id, ctx.transactions, shift_id, db_)
+        dal.insert_items(invoice_id, ctx.items, db_)
+        bundle_ids = dal.insert_bundles(invoice_id, ctx.bundles, db_)
+        dal.insert_tests(invoice_id, ctx.tests, db_, bundle_ids)
+    return invoice_id
 
 
 def filter_orders(orders: list[OrderContext], barrier: int) -> list[OrderContext]:
@@ -129,31 +127,29 @@ def filter_orders(orders: list[OrderContext], barrier: int) -> list[OrderContext
 
 
 def reconcile_shifts(shift_map: dict[int, int], db_: Database):
-    croak(f"Found {len(shift_map.keys())} shifts")
-    for uid in shift_map.keys():
-        croak(f"Reconciling shift #{shift_map[uid]}")
-        dal.reconcile_shift(shift_map[uid], True, db_)
+    croak(f"Reconciling {len(shift_map.keys())} shifts")
+    dal.reconcile_shifts(list(shift_map.values()), True, db_)
 
 
 def time_spread_invoices(orders: list[OrderContext], dt: date):
-    sod = datetime.combine(dt, datetime.min.time()) + timedelta(
-        hours=START_HOURS, minutes=random.randint(3, 12)
-    )
-    eod = datetime.combine(dt, datetime.min.time()) + timedelta(
-        hours=END_HOURS - 1, minutes=random.randint(45, 57)
-    )
-    total_seconds = (eod - sod).total_seconds()
-    interval = total_seconds / len(orders)
-
-    for i, ord in enumerate(orders):
-        ord.order.OrderDateTime = sod + timedelta(seconds=i * interval)
+    times = utils.spread_times(dt, len(orders), START_HOURS, END_HOURS)
+    for ord, order_time in zip(orders, times):
+        ord.order.OrderDateTime = order_time
 
 
 def populate_shadow(orders: list[OrderContext], dt: date):
-    with db.Database.make(DB_DEST) as db_:
+    # the whole day commits once; each chain is a savepoint inside it
+    with Database.pooled(DB_DEST) as db_, db_.transaction():
+        # one query for everything already replicated, instead of finding
+        # out chain by chain
+        replicated = dal.replicated_ids(dt, dt, db_)
         shift_map = recreate_shifts(orders, dt, db_)
         for ord in orders:
-            insert_lab_order_chain(ord, shift_map, db_)
+            if ord.order.InvoiceId in replicated:
+                croak(f"Skipping #{ord.order.InvoiceId}. already exists")
+                continue
+            if insert_lab_order_chain(ord, shift_map, db_):
+                replicated.add(ord.order.InvoiceId)
 
         reconcile_shifts(shift_map, db_)
 
@@ -0,0 +1,43 @@
+import argparse
+import sys
+
+import yaml
+
+from src import db, schema
+from src.utils import croak
+
+with open("config.yml", "r") as file:
+    config = yaml.safe_load(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the indexes the date-scoped queries rely on"
+    )
+    parser.add_argument("target", choices=["src", "dst"], help="database to inspect")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument(
+        "--print", action="store_true", help="print the DDL without connecting"
+    )
+    action.add_argument(
+        "--create", action="store_true", help="create the missing indexes"
+    )
+    args = parser.parse_args()
+
+    if args.print:
+        for ix in schema.indexes_for(args.target):
+            print(ix.ddl())
+        sys.exit(0)
+
+    with db.Database.make(config["db"][args.target]) as db_:
+        missing = schema.missing_indexes(args.target, db_)
+        for ix in schema.indexes_for(args.target):
+            status = "MISSING" if ix in missing else "ok"
+            croak(f"{status:<8} {ix.table} ({', '.join(ix.keys)})")
+
+        if args.create:
+            for ix in missing:
+                croak(f"Creating {ix.name} on {ix.table}")
+                db_.execute(ix.ddl())
+        elif missing:
+            sys.exit(1)
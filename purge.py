@@ -4,7 +4,7 @@ import arrow
 import yaml
 
 from src import db, dal
-from src.utils import croak
+from src.utils import croak, report_purge
 
 with open("config.yml", "r") as file:
     config = yaml.safe_load(file)
@@ -15,12 +15,8 @@ DB_DEST = config["db"]["dst"]
 
 def purge_orders(dt: date):
     with db.Database.make(DB_DEST) as db_:
-        invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt}")
-
-        for ord in invoices:
-            croak(f"Purging #{ord.InvoiceId} - {ord.OrderId}")
-            dal.purge_order_chain(ord.InvoiceId, db_)
+        purged = dal.purge_chains(dt, dt, db_, progress=report_purge)
+        croak(f"Purged {purged} invoices for {dt}")
 
 
 if __name__ == "__main__":
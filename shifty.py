@@ -1,58 +1,52 @@
+import argparse
 from datetime import date
 
 import yaml
-import arrow
 
 from src import db, dal
 from src.db import Database
-from src.models import LabOrder
+from src.shifts import ShiftRegistry
 from src.utils import croak
 
 with open("config.yml", "r") as file:
     config = yaml.safe_load(file)
 
 DB_DEST = config["db"]["dst"]
+SHIFTS = ShiftRegistry()
 
 
-def ensure_shift(orders: list[LabOrder], dt: date, db_: Database):
-    shifts = []
-    for ord in orders:
-        shift_id = dal.find_shift(ord.OrderingUserId, dt, db_)
-        if not shift_id:
-            shift_id = dal.create_shift(ord.OrderingUserId, dt, db_)
-
-        if shift_id:
-            db_.execute(
-                "UPDATE PROE.PatientLabOrders SET WorkShiftId = ? WHERE InvoiceId = ?",
-                shift_id,
-                ord.InvoiceId,
-            )
-            db_.execute(
-                "UPDATE Finances.InvoiceTransactions SET WorkShiftId = ? WHERE InvoiceId = ?",
-                shift_id,
-                ord.InvoiceId,
-            )
-            shifts.append(shift_id)
-
-    for sid in sorted(set(shifts)):
-        croak(f"Reconciling shift #{sid}")
-        dal.reconcile_shift(sid, True, db_)
-
-
-with db.Database.make(DB_DEST) as db_:
-    start_date = arrow.get("2024-12-11")
-    end_date = arrow.get("2024-12-18")
-
-    dates = db_.fetch_scalars(
-        "SELECT DISTINCT CAST(OrderDateTime AS DATE) AS D FROM PROE.PatientLabOrders",
-        "D",
-    )
-    dates = sorted(set(dates))
-    croak(f"Found {len(dates)} unique dates")
-
-    dt = start_date
-    while dt <= end_date:
-        invoices = dal.fetch_invoices(dt.date(), db_)
-        croak(f"Found {len(invoices)} invoices for {dt.date()}")
-        ensure_shift(invoices, dt.date(), db_)
-        dt = dt.shift(days=1)
+def build_shift_map(
+    first_day: date, last_day: date, db_: Database
+) -> list[tuple[date, int, int]]:
+    # (day, OrderingUserId, shift id) for every user who ordered in the range
+    SHIFTS.load(first_day, last_day, db_)
+    rows = []
+    for dt, user_ids in sorted(dal.order_users(first_day, last_day, db_).items()):
+        for uid, shift_id in SHIFTS.ensure(user_ids, dt, db_).items():
+            rows.append((dt, uid, shift_id))
+    return rows
+
+
+def reassign_shifts(first_day: date, last_day: date, db_: Database):
+    shift_map = build_shift_map(first_day, last_day, db_)
+    croak(f"Staging {len(shift_map)} user shifts")
+    dal.stage_shift_map(shift_map, db_)
+
+    for dt in dal.order_dates(db_, first_day, last_day):
+        with db_.transaction():
+            orders, transactions = dal.apply_shift_map(dt, db_)
+        croak(f"{dt}: {orders} orders, {transactions} transactions reassigned")
+
+    shift_ids = sorted({shift_id for _, _, shift_id in shift_map})
+    croak(f"Reconciling {len(shift_ids)} shifts")
+    dal.reconcile_shifts(shift_ids, True, db_)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reassign orders to work shifts")
+    parser.add_argument("start", type=date.fromisoformat, help="first day (ISO)")
+    parser.add_argument("end", type=date.fromisoformat, help="last day (ISO)")
+    args = parser.parse_args()
+
+    with db.Database.make(DB_DEST) as db_:
+        reassign_shifts(args.start, args.end, db_)
@@ -1,50 +1,35 @@
-import random
-from datetime import date, datetime, timedelta
-import arrow
+import argparse
+from datetime import date
+
 import yaml
 
-from src import db, dal
+from src import db, dal, utils
 from src.db import Database
-from src.models import LabOrder
 from src.utils import croak
-from src.catalogs import OrderContext
 
 with open("config.yml", "r") as file:
     config = yaml.safe_load(file)
 
 DB_DEST = config["db"]["dst"]
+START_HOURS = int(config["main"]["business_hours"]["start"])
+END_HOURS = int(config["main"]["business_hours"]["end"])
+
+
+def time_spread_invoices(dt: date, db_: Database) -> int:
+    invoice_ids = dal.order_ids(dt, db_)
+    times = utils.spread_times(dt, len(invoice_ids), START_HOURS, END_HOURS)
+    with db_.transaction():
+        return dal.set_order_times(list(zip(invoice_ids, times)), db_)
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spread orders over business hours")
+    parser.add_argument("start", type=date.fromisoformat, help="first day (ISO)")
+    parser.add_argument("end", type=date.fromisoformat, help="last day (ISO)")
+    args = parser.parse_args()
 
-def time_spread_invoices(orders: list[LabOrder], dt: date, db_: Database):
-    sod = datetime.combine(dt, datetime.min.time()) + timedelta(
-        hours=8, minutes=random.randint(3, 12)
-    )
-    eod = datetime.combine(dt, datetime.min.time()) + timedelta(
-        hours=21, minutes=random.randint(45, 57)
-    )
-    total_seconds = (eod - sod).total_seconds()
-    interval = total_seconds / len(orders)
-
-    for i, ord in enumerate(orders):
-        order_time = sod + timedelta(seconds=i * interval)
-        croak(
-            f"#{ord.InvoiceId} ({ord.OrderId}) Before: {ord.OrderDateTime:%H:%M:%S} After: {order_time:%H:%M:%S}"
-        )
-        db_.execute(
-            "UPDATE PROE.PatientLabOrders SET OrderDateTime = ? WHERE InvoiceId = ?",
-            order_time,
-            ord.InvoiceId,
-        )
-
-
-with db.Database.make(DB_DEST) as db_:
-    dates = db_.fetch_scalars(
-        "SELECT DISTINCT CAST(OrderDateTime AS DATE) AS D FROM PROE.PatientLabOrders",
-        "D",
-    )
-    dates = sorted(set(dates))
-    croak(f"Found {len(dates)} unique dates")
-    for dt in dates:
-        invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt}")
-        time_spread_invoices(invoices, dt, db_)
+    with db.Database.make(DB_DEST) as db_:
+        dates = dal.order_dates(db_, args.start, args.end)
+        croak(f"Found {len(dates)} unique dates")
+        for dt in dates:
+            croak(f"Spread {time_spread_invoices(dt, db_)} invoices for {dt}")
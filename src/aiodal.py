@@ -0,0 +1,55 @@
+import asyncio
+import datetime
+
+from src import dal, models
+from src.catalogs import OrderContext, ReferenceData
+from src.dal import Catalog
+from src.db import AsyncDatabase
+
+# async counterparts of the dal functions used by the replication loop; each
+# runs the blocking dal call on the AsyncDatabase's connection thread
+
+
+async def fetch_invoice_page(
+    dt: datetime.date,
+    after_id: int,
+    limit: int,
+    adb: AsyncDatabase,
+    referrers: Catalog | None = None,
+) -> list[models.LabOrder]:
+    return await adb.call(
+        dal.fetch_invoice_page, dt, after_id, limit, referrers=referrers
+    )
+
+
+async def refresh_reference_data(refs: ReferenceData, adb: AsyncDatabase) -> set[str]:
+    return await adb.call(refs.refresh)
+
+
+async def scan_all(
+    orders: list[models.LabOrder],
+    adbs: list[AsyncDatabase],
+    refs: ReferenceData | None = None,
+) -> list[OrderContext]:
+    # the six child-table reads are spread round-robin over `adbs`, so with
+    # several connections they are in flight at the same time
+    if not orders:
+        return []
+
+    first_id, last_id = OrderContext.span(orders)
+    lab_tests, billable_items = (
+        (refs.lab_tests, refs.billable_items) if refs else (None, None)
+    )
+    reads = [
+        (dal.range_tests, lab_tests),
+        (dal.range_items, billable_items),
+        (dal.range_bundles,),
+        (dal.range_masters,),
+        (dal.range_primals,),
+        (dal.range_transactions,),
+    ]
+    pending = []
+    for i, (fn, *catalog) in enumerate(reads):
+        adb = adbs[i % len(adbs)]
+        pending.append(adb.run(fn, first_id, last_id, adb.db, *catalog))
+    return OrderContext.assemble(orders, *await asyncio.gather(*pending))
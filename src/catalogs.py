@@ -1,16 +1,89 @@
+import threading
+from collections import defaultdict
+
 from src import models
 from src.db import Database
 from src.dal import (
+    get_lab_tests,
+    get_billable_items,
+    get_referrers,
+    get_staff_catalog,
+    reference_fingerprints,
     invoice_tests,
     invoice_items,
     invoice_bundles,
     invoice_master,
     invoice_primal,
     invoice_transactions,
+    range_tests,
+    range_items,
+    range_bundles,
+    range_masters,
+    range_primals,
+    range_transactions,
     Catalog,
 )
 
 
+def group_by_invoice(rows: list) -> dict[int, list]:
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row.InvoiceId].append(row)
+    return groups
+
+
+class ReferenceData:
+    """In-process copy of the catalogs the hot queries used to join on.
+
+    refresh() costs one fingerprint query; a catalog is only reloaded when
+    its fingerprint moved since the previous load.
+    """
+
+    # fingerprint columns -> the catalog they invalidate
+    SOURCES = {
+        "LabTests": "lab_tests",
+        "Labs": "lab_tests",
+        "BillableItems": "billable_items",
+        "Referrers": "referrers",
+        "Users": "users",
+    }
+
+    def __init__(self):
+        self._fingerprints: dict[str, int | None] = {}
+        self._lock = threading.Lock()
+        self.lab_tests = Catalog([])
+        self.active_tests = Catalog([])
+        self.billable_items = Catalog([])
+        self.referrers = Catalog([])
+        self.users = Catalog([])
+
+    def refresh(self, db_: Database) -> set[str]:
+        with self._lock:
+            prints = reference_fingerprints(db_)
+            stale = {
+                self.SOURCES[k]
+                for k, v in prints.items()
+                if k not in self._fingerprints or self._fingerprints[k] != v
+            }
+
+            if "lab_tests" in stale:
+                self.lab_tests = get_lab_tests(db_)
+                self.active_tests = Catalog(
+                    [t for t in self.lab_tests if t.IsActive and t.LabIsActive],
+                    "TestSKU",
+                    "LabName",
+                )
+            if "billable_items" in stale:
+                self.billable_items = get_billable_items(db_)
+            if "referrers" in stale:
+                self.referrers = get_referrers(db_)
+            if "users" in stale:
+                self.users = get_staff_catalog(db_)
+
+            self._fingerprints = prints
+            return stale
+
+
 class OrderContext:
     order: models.LabOrder
     tests: list[models.OrderedLabTest] = []
@@ -20,22 +93,93 @@ class OrderContext:
     primal: models.Invoice
     transactions: list[models.InvoiceTransaction] = []
 
+    _bundle_index: dict[int, models.ResultBundle] | None = None
+    _indexed_bundles: list[models.ResultBundle] | None = None
+
     def __init__(self, order: models.LabOrder):
         self.order = order
 
-    def scan(self, db_: Database):
-        self.tests = invoice_tests(self.order.InvoiceId, db_)
-        self.items = invoice_items(self.order.InvoiceId, db_)
+    def scan(self, db_: Database, refs: ReferenceData | None = None):
+        tests, items = (refs.lab_tests, refs.billable_items) if refs else (None, None)
+        self.tests = invoice_tests(self.order.InvoiceId, db_, tests)
+        self.items = invoice_items(self.order.InvoiceId, db_, items)
         self.bundles = invoice_bundles(self.order.InvoiceId, db_)
         self.master = invoice_master(self.order.InvoiceId, db_)
         self.primal = invoice_primal(self.order.InvoiceId, db_)
         self.transactions = invoice_transactions(self.order.InvoiceId, db_)
 
+    @staticmethod
+    def scan_all(
+        orders: list[models.LabOrder], db_: Database, refs: ReferenceData | None = None
+    ) -> list["OrderContext"]:
+        # one query per child table for the whole InvoiceId span of `orders`;
+        # rows belonging to invoices outside of `orders` are simply dropped
+        if not orders:
+            return []
+
+        first_id, last_id = OrderContext.span(orders)
+        lab_tests, billable_items = (
+            (refs.lab_tests, refs.billable_items) if refs else (None, None)
+        )
+        return OrderContext.assemble(
+            orders,
+            range_tests(first_id, last_id, db_, lab_tests),
+            range_items(first_id, last_id, db_, billable_items),
+            range_bundles(first_id, last_id, db_),
+            range_masters(first_id, last_id, db_),
+            range_primals(first_id, last_id, db_),
+            range_transactions(first_id, last_id, db_),
+        )
+
+    @staticmethod
+    def span(orders: list[models.LabOrder]) -> tuple[int, int]:
+        ids = [o.InvoiceId for o in orders]
+        return min(ids), max(ids)
+
+    @staticmethod
+    def assemble(
+        orders: list[models.LabOrder],
+        tests: list[models.OrderedLabTest],
+        items: list[models.OrderedBillableItem],
+        bundles: list[models.ResultBundle],
+        masters: list[models.Invoice],
+        primals: list[models.Invoice],
+        transactions: list[models.InvoiceTransaction],
+    ) -> list["OrderContext"]:
+        tests = group_by_invoice(tests)
+        items = group_by_invoice(items)
+        bundles = group_by_invoice(bundles)
+        masters = {m.InvoiceId: m for m in masters}
+        primals = {p.InvoiceId: p for p in primals}
+        transactions = group_by_invoice(transactions)
+
+        contexts = []
+        for order in orders:
+            ctx = OrderContext(order)
+            ctx.tests = tests.get(order.InvoiceId, [])
+            ctx.items = items.get(order.InvoiceId, [])
+            ctx.bundles = bundles.get(order.InvoiceId, [])
+            ctx.master = masters[order.InvoiceId]
+            ctx.primal = primals[order.InvoiceId]
+            ctx.transactions = transactions.get(order.InvoiceId, [])
+            contexts.append(ctx)
+        return contexts
+
+    def bundle_index(self) -> dict[int, models.ResultBundle]:
+        # LabId -> bundle. When a lab has several bundles the earliest one
+        # (lowest Id) owns the lab's tests; the others are still replicated.
+        if self._bundle_index is None or self._indexed_bundles is not self.bundles:
+            index = {}
+            for bundle in sorted(self.bundles, key=lambda b: b.Id):
+                index.setdefault(bundle.LabId, bundle)
+            self._bundle_index = index
+            self._indexed_bundles = self.bundles
+        return self._bundle_index
+
     def sanitize_tests(self, catalog: Catalog):
-        tests = [t for t in self.tests if t.LabTestId in catalog.keys()]
-        self.tests = []
-        for test in tests:
-            for bundle in self.bundles:
-                if bundle.LabId == test.LabId:
-                    test.ResultBundleId = bundle.Id
-            self.tests.append(test)
+        bundles = self.bundle_index()
+        self.tests = [t for t in self.tests if t.LabTestId in catalog]
+        for test in self.tests:
+            bundle = bundles.get(test.LabId)
+            if bundle:
+                test.ResultBundleId = bundle.Id
@@ -1,63 +1,266 @@
 import datetime
+import decimal
 import enum
+from collections import defaultdict
+from collections.abc import Callable, Iterator, KeysView
+
+import pyodbc
 
 from src import models, utils
 from src.db import Database
 from src.models import TransactionType
 
+INVOICE_PAGE_SIZE = 500
+
 
 class Catalog:
-    def __init__(self, items: list):
-        self._items = items
+    """Reference rows keyed by `Id`, with optional secondary indexes.
+
+    Secondary indexes map a field value to the tuple of matching rows, since
+    fields such as `LabName` are shared by many rows.
+    """
+
+    __slots__ = ("_items", "_indexes")
+
+    def __init__(self, items: list, *indexes: str):
+        self._items = {item.Id: item for item in items}
+        self._indexes: dict[str, dict] = {}
+        for field in indexes:
+            index = defaultdict(list)
+            for item in self._items.values():
+                index[getattr(item, field)].append(item)
+            self._indexes[field] = {k: tuple(v) for k, v in index.items()}
 
     def find(self, key: int):
-        for item in self._items:
-            if item.Id == key:
-                return item
-        return None
+        return self._items.get(key)
+
+    def find_by(self, field: str, value):
+        matches = self._indexes[field].get(value)
+        return matches[0] if matches else None
+
+    def filter_by(self, field: str, value) -> tuple:
+        return self._indexes[field].get(value, ())
+
+    def keys(self) -> KeysView[int]:
+        return self._items.keys()
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._items
 
-    def keys(self) -> list[int]:
-        return [item.Id for item in self._items]
+    def __len__(self) -> int:
+        return len(self._items)
 
     def __iter__(self):
-        return iter(self._items)
+        return iter(self._items.values())
 
 
-def fetch_invoices(dt: datetime.date, db_: Database) -> list[models.LabOrder]:
-    sql = """
-SELECT
+def _orders_sql(referrers: Catalog | None, top: bool = False) -> str:
+    # with a local referrers catalog the Referrers join is resolved in Python
+    select = "SELECT TOP (?)" if top else "SELECT"
+    if referrers is not None:
+        return f"""
+{select}
+    ord.*
+FROM
+    PROE.PatientLabOrders AS ord
+"""
+    return f"""
+{select}
     ord.*,
     COALESCE(ref.FullName, ord.ReferrerCustomName, '') AS ReferrerCustomName
 FROM
     PROE.PatientLabOrders AS ord
     LEFT JOIN [Catalog].Referrers AS ref ON ord.ReferrerId = ref.Id 
+"""
+
+
+def _referrer_resolver(referrers: Catalog | None):
+    if referrers is None:
+        return None
+
+    def resolve(values: dict) -> dict:
+        # local equivalent of COALESCE(ref.FullName, ord.ReferrerCustomName, '')
+        ref = referrers.find(values.get("ReferrerId"))
+        name = ref.FullName if ref else None
+        values["ReferrerCustomName"] = name or values.get("ReferrerCustomName") or ""
+        return values
+
+    return resolve
+
+
+def _test_resolver(tests: Catalog):
+    def resolve(values: dict) -> dict | None:
+        # local equivalent of INNER JOIN [Catalog].LabTests
+        tst = tests.find(values["LabTestId"])
+        if tst is None:
+            return None
+        values["TestName"] = tst.ShortName
+        values["LabId"] = tst.PerformingLabId
+        return values
+
+    return resolve
+
+
+def _item_resolver(items: Catalog):
+    def resolve(values: dict) -> dict | None:
+        # local equivalent of INNER JOIN [Catalog].BillableItems
+        bi = items.find(values["BillableItemId"])
+        if bi is None:
+            return None
+        values["BillableItemName"] = bi.Name
+        return values
+
+    return resolve
+
+
+def fetch_invoices(
+    dt: datetime.date, db_: Database, referrers: Catalog | None = None
+) -> list[models.LabOrder]:
+    sql = _orders_sql(referrers) + """
 WHERE
-    CAST (ord.OrderDateTime AS DATE) = ?
+    ord.OrderDateTime >= ? AND
+    ord.OrderDateTime < ?
 ORDER BY
-    ord.InvoiceId            
+    ord.InvoiceId
     """
-    rows = db_.fetch_all(sql, dt)
-    return [models.LabOrder(**row) for row in rows]
+    prepare = _referrer_resolver(referrers)
+    return db_.fetch_models(
+        models.LabOrder, sql, *utils.day_bounds(dt), prepare=prepare
+    )
 
 
 def fetch_invoices_after(
-    dt: datetime.date, last_id: int, db_: Database
+    dt: datetime.date, last_id: int, db_: Database, referrers: Catalog | None = None
+) -> list[models.LabOrder]:
+    sql = _orders_sql(referrers) + """
+WHERE
+    ord.InvoiceId > ? AND
+    ord.OrderDateTime >= ? AND
+    ord.OrderDateTime < ?
+ORDER BY
+    ord.InvoiceId
+    """
+    prepare = _referrer_resolver(referrers)
+    return db_.fetch_models(
+        models.LabOrder, sql, last_id, *utils.day_bounds(dt), prepare=prepare
+    )
+
+
+def fetch_invoice_page(
+    dt: datetime.date,
+    after_id: int,
+    limit: int,
+    db_: Database,
+    referrers: Catalog | None = None,
+    until_id: int | None = None,
 ) -> list[models.LabOrder]:
+    params = [limit, after_id, *utils.day_bounds(dt)]
+    sql = _orders_sql(referrers, top=True) + """
+WHERE
+    ord.InvoiceId > ? AND
+    ord.OrderDateTime >= ? AND
+    ord.OrderDateTime < ?
+"""
+    if until_id is not None:
+        sql += "    AND ord.InvoiceId <= ?\n"
+        params.append(until_id)
+    sql += "ORDER BY\n    ord.InvoiceId\n"
+    prepare = _referrer_resolver(referrers)
+    return db_.fetch_models(models.LabOrder, sql, *params, prepare=prepare)
+
+
+def iter_invoice_pages(
+    dt: datetime.date,
+    db_: Database,
+    after_id: int | None = None,
+    page_size: int = INVOICE_PAGE_SIZE,
+    referrers: Catalog | None = None,
+    until_id: int | None = None,
+) -> Iterator[list[models.LabOrder]]:
+    # keyset pagination on InvoiceId: every page is a fresh, bounded query, so
+    # the connection is free for other statements between pages
+    after_id = after_id or 0
+    while True:
+        page = fetch_invoice_page(dt, after_id, page_size, db_, referrers, until_id)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after_id = page[-1].InvoiceId
+
+
+def invoice_nets(
+    dt: datetime.date, db_: Database
+) -> list[tuple[int, decimal.Decimal]]:
+    # (InvoiceId, NetPayable) for the whole day, in InvoiceId order: enough
+    # to price the day before anything is hydrated
     sql = """
 SELECT
-    ord.*,
-    COALESCE(ref.FullName, ord.ReferrerCustomName, '') AS ReferrerCustomName
+  ord.InvoiceId,
+  inv.NetPayable
 FROM
-    PROE.PatientLabOrders AS ord
-    LEFT JOIN [Catalog].Referrers AS ref ON ord.ReferrerId = ref.Id 
+  PROE.PatientLabOrders AS ord
+  INNER JOIN Finances.InvoiceMaster AS inv ON inv.InvoiceId = ord.InvoiceId
 WHERE
-    InvoiceId > ? AND
-    CAST (ord.OrderDateTime AS DATE) = ?
+  ord.OrderDateTime >= ?
+  AND ord.OrderDateTime < ?
 ORDER BY
-    ord.InvoiceId
+  ord.InvoiceId
+    """
+    rows = db_.iter_rows(sql, *utils.day_bounds(dt))
+    return [(row.InvoiceId, row.NetPayable) for row in rows]
+
+
+def order_ids(dt: datetime.date, db_: Database) -> list[int]:
+    sql = """
+SELECT InvoiceId
+FROM PROE.PatientLabOrders
+WHERE OrderDateTime >= ? AND OrderDateTime < ?
+ORDER BY InvoiceId
     """
-    rows = db_.fetch_all(sql, last_id, dt)
-    return [models.LabOrder(**row) for row in rows]
+    return db_.fetch_scalars(sql, "InvoiceId", *utils.day_bounds(dt))
+
+
+def set_order_times(rows: list[tuple[int, datetime.datetime]], db_: Database) -> int:
+    # (InvoiceId, OrderDateTime) pairs staged in #Spread, applied in one join
+    sql = """
+IF OBJECT_ID('tempdb..#Spread') IS NOT NULL DROP TABLE #Spread;
+CREATE TABLE #Spread (
+  InvoiceId BIGINT NOT NULL PRIMARY KEY,
+  OrderDateTime DATETIME NOT NULL
+);
+    """
+    db_.execute(sql)
+    db_.execute_many(
+        "INSERT INTO #Spread (InvoiceId, OrderDateTime) VALUES (?, ?)",
+        rows,
+        [(pyodbc.SQL_BIGINT, 0, 0), (pyodbc.SQL_TYPE_TIMESTAMP, 23, 3)],
+    )
+    sql = """
+UPDATE ord SET
+  OrderDateTime = s.OrderDateTime
+FROM
+  PROE.PatientLabOrders AS ord
+  INNER JOIN #Spread AS s ON s.InvoiceId = ord.InvoiceId
+    """
+    return db_.execute(sql)
+
+
+def order_dates(
+    db_: Database,
+    first_day: datetime.date | None = None,
+    last_day: datetime.date | None = None,
+) -> list[datetime.date]:
+    # the CAST only shapes the output; the filter stays a range on the column
+    sql = """
+SELECT DISTINCT CAST(OrderDateTime AS DATE) AS D
+FROM PROE.PatientLabOrders
+    """
+    params = []
+    if first_day:
+        sql += "WHERE OrderDateTime >= ? AND OrderDateTime < ?\n"
+        params = utils.day_bounds(first_day, last_day)
+    return db_.fetch_scalars(sql + "ORDER BY D", "D", *params)
 
 
 def get_test_catalog(db_: Database) -> Catalog:
@@ -72,8 +275,48 @@ WHERE
   LabTests.IsActive = 1 
   AND Labs.IsActive = 1    
     """
-    rows = db_.fetch_all(sql)
-    return Catalog([models.LabTest(**row) for row in rows])
+    items = db_.fetch_models(models.LabTest, sql)
+    return Catalog(items, "TestSKU", "LabName")
+
+
+def get_lab_tests(db_: Database) -> Catalog:
+    # every test, active or not, so that historic orders still resolve
+    sql = """
+SELECT
+  LabTests.*,
+  Labs.Name AS LabName,
+  Labs.IsActive AS LabIsActive
+FROM
+  [Catalog].LabTests
+  INNER JOIN [Catalog].Labs ON LabTests.PerformingLabId = Labs.Id 
+    """
+    items = db_.fetch_models(models.LabTest, sql)
+    return Catalog(items, "TestSKU", "LabName")
+
+
+def get_billable_items(db_: Database) -> Catalog:
+    sql = "SELECT Id, Name FROM [Catalog].BillableItems"
+    items = db_.fetch_models(models.BillableItem, sql)
+    return Catalog(items)
+
+
+def get_referrers(db_: Database) -> Catalog:
+    sql = "SELECT Id, FullName FROM [Catalog].Referrers"
+    items = db_.fetch_models(models.Referrer, sql)
+    return Catalog(items)
+
+
+def reference_fingerprints(db_: Database) -> dict[str, int | None]:
+    # one cheap round trip; a value moves whenever any row of the table changes
+    sql = """
+SELECT
+  (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [Catalog].LabTests) AS LabTests,
+  (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [Catalog].Labs) AS Labs,
+  (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [Catalog].BillableItems) AS BillableItems,
+  (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [Catalog].Referrers) AS Referrers,
+  (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM Staff.Users) AS Users
+    """
+    return db_.fetch(sql)
 
 
 def get_staff_catalog(db_: Database) -> Catalog:
@@ -85,11 +328,20 @@ FROM
 WHERE
   IsActive = 1 
     """
-    rows = db_.fetch_all(sql)
-    return Catalog([models.User(**row) for row in rows])
+    items = db_.fetch_models(models.User, sql)
+    return Catalog(items, "UserName")
+
 
+def invoice_tests(
+    invoice_id: int, db_: Database, tests: Catalog | None = None
+) -> list[models.OrderedLabTest]:
+    if tests is not None:
+        sql = "SELECT * FROM PROE.OrderedTests WHERE IsCancelled = 0 AND InvoiceId = ?"
+        prepare = _test_resolver(tests)
+        return db_.fetch_models(
+            models.OrderedLabTest, sql, invoice_id, prepare=prepare
+        )
 
-def invoice_tests(invoice_id: int, db_: Database) -> list[models.OrderedLabTest]:
     sql = """
 SELECT
   ot.*,
@@ -103,11 +355,19 @@ WHERE
   ot.IsCancelled = 0 
   AND ord.InvoiceId = ?    
     """
-    rows = db_.fetch_all(sql, invoice_id)
-    return [models.OrderedLabTest(**row) for row in rows]
+    return db_.fetch_models(models.OrderedLabTest, sql, invoice_id)
 
 
-def invoice_items(invoice_id: int, db_: Database) -> list[models.OrderedBillableItem]:
+def invoice_items(
+    invoice_id: int, db_: Database, items: Catalog | None = None
+) -> list[models.OrderedBillableItem]:
+    if items is not None:
+        sql = "SELECT * FROM PROE.OrderedBillableItems WHERE InvoiceId = ? AND IsCancelled = 0"
+        prepare = _item_resolver(items)
+        return db_.fetch_models(
+            models.OrderedBillableItem, sql, invoice_id, prepare=prepare
+        )
+
     sql = """
 SELECT
   obi.*,
@@ -120,14 +380,122 @@ WHERE
   ord.InvoiceId = ? 
   AND obi.IsCancelled = 0
     """
-    rows = db_.fetch_all(sql, invoice_id)
-    return [models.OrderedBillableItem(**row) for row in rows]
+    return db_.fetch_models(models.OrderedBillableItem, sql, invoice_id)
 
 
 def purge_order_chain(invoice_id: int, db_: Database):
     db_.execute("EXEC PROE.SP_ShadowPurgeLabOrderChain ?", invoice_id)
 
 
+# what PROE.SP_ShadowPurgeLabOrderChain removes, children first
+CHAIN_TABLES = [
+    "PROE.OrderedTests",
+    "PROE.OrderedBillableItems",
+    "TestResults.ResultBundles",
+    "Finances.InvoiceTransactions",
+    "Finances.InvoicePrimal",
+    "Finances.InvoiceMaster",
+]
+# OrderedTests rows per purge chunk: the widest child table, kept under SQL
+# Server's ~5,000-lock escalation threshold so a chunk never locks the table
+PURGE_CHUNK_ROWS = 4_000
+
+
+def order_id_span(
+    first_day: datetime.date, last_day: datetime.date, db_: Database
+) -> tuple[int | None, int | None]:
+    sql = """
+SELECT
+  MIN(InvoiceId) AS FirstId,
+  MAX(InvoiceId) AS LastId
+FROM
+  PROE.PatientLabOrders
+WHERE
+  OrderDateTime >= ?
+  AND OrderDateTime < ?
+    """
+    row = db_.fetch(sql, *utils.day_bounds(first_day, last_day))
+    return row["FirstId"], row["LastId"]
+
+
+def purge_chunks(
+    first_day: datetime.date, last_day: datetime.date, max_rows: int, db_: Database
+) -> list[tuple[int, int]]:
+    # InvoiceId ranges of the days' orders holding at most `max_rows` tests
+    # each; an invoice with more tests than that is a chunk of its own
+    sql = """
+SELECT
+  ord.InvoiceId,
+  COUNT(t.InvoiceId) AS Tests
+FROM
+  PROE.PatientLabOrders AS ord
+  LEFT JOIN PROE.OrderedTests AS t ON t.InvoiceId = ord.InvoiceId
+WHERE
+  ord.OrderDateTime >= ?
+  AND ord.OrderDateTime < ?
+GROUP BY
+  ord.InvoiceId
+ORDER BY
+  ord.InvoiceId
+    """
+    chunks = []
+    lo = hi = None
+    rows = 0
+    for row in db_.iter_rows(sql, *utils.day_bounds(first_day, last_day)):
+        if lo is not None and rows + row.Tests > max_rows:
+            chunks.append((lo, hi))
+            lo = None
+        if lo is None:
+            lo, rows = row.InvoiceId, 0
+        hi = row.InvoiceId
+        rows += row.Tests
+    if lo is not None:
+        chunks.append((lo, hi))
+    return chunks
+
+
+def purge_chains(
+    first_day: datetime.date,
+    last_day: datetime.date,
+    db_: Database,
+    chunk_rows: int = PURGE_CHUNK_ROWS,
+    progress: Callable[[int, int], None] | None = None,
+) -> int:
+    # set-based replacement for one purge_order_chain() call per invoice: each
+    # InvoiceId chunk is one transaction, which keeps the log and the lock
+    # footprint bounded. progress(purged_so_far, last_id_of_chunk) per chunk.
+    bounds = utils.day_bounds(first_day, last_day)
+    purged = 0
+    for lo, hi in purge_chunks(first_day, last_day, chunk_rows, db_):
+        with db_.transaction():
+            for table in CHAIN_TABLES:
+                sql = f"""
+DELETE child
+FROM
+  {table} AS child
+  INNER JOIN PROE.PatientLabOrders AS ord ON child.InvoiceId = ord.InvoiceId
+WHERE
+  ord.InvoiceId BETWEEN ? AND ?
+  AND ord.OrderDateTime >= ?
+  AND ord.OrderDateTime < ?
+                """
+                db_.execute(sql, lo, hi, *bounds)
+
+            sql = """
+DELETE FROM
+  PROE.PatientLabOrders
+WHERE
+  InvoiceId BETWEEN ? AND ?
+  AND OrderDateTime >= ?
+  AND OrderDateTime < ?
+            """
+            purged += db_.execute(sql, lo, hi, *bounds)
+
+        if progress:
+            progress(purged, hi)
+    return purged
+
+
 def invoice_bundles(invoice_id: int, db_: Database) -> list[models.ResultBundle]:
     sql = """
 SELECT
@@ -136,106 +504,238 @@ FROM
   TestResults.ResultBundles 
 WHERE
   InvoiceId = ? 
-  AND IsActive = 1    
+  AND IsActive = 1
+ORDER BY
+  Id
     """
-    rows = db_.fetch_all(sql, invoice_id)
-    return [models.ResultBundle(**row) for row in rows]
+    return db_.fetch_models(models.ResultBundle, sql, invoice_id)
 
 
 def invoice_master(invoice_id: int, db_: Database) -> models.Invoice:
     sql = "SELECT TOP 1 * FROM Finances.InvoiceMaster AS inv WHERE InvoiceId = ?"
-    return models.Invoice(**db_.fetch(sql, invoice_id))
+    return db_.fetch_model(models.Invoice, sql, invoice_id)
 
 
 def invoice_primal(invoice_id: int, db_: Database) -> models.Invoice:
     sql = "SELECT TOP 1 * FROM Finances.InvoicePrimal AS inv WHERE InvoiceId = ?"
-    return models.Invoice(**db_.fetch(sql, invoice_id))
+    return db_.fetch_model(models.Invoice, sql, invoice_id)
 
 
 def invoice_transactions(
     invoice_id: int, db_: Database
 ) -> list[models.InvoiceTransaction]:
     sql = "SELECT TOP 1 * FROM Finances.InvoiceTransactions AS inv WHERE InvoiceId = ?"
-    rows = db_.fetch_all(sql, invoice_id)
-    return [models.InvoiceTransaction(**row) for row in rows]
+    return db_.fetch_models(models.InvoiceTransaction, sql, invoice_id)
 
 
-def last_src_invoice_id(dt: datetime.date, db_: Database) -> int | None:
-    sql = "SELECT MAX(SourceInvoiceId) AS _id_ FROM PROE.PatientLabOrders WHERE CAST (OrderDateTime AS DATE) = ?"
-    return db_.fetch_scalar(sql, "_id_", dt)
+def range_tests(
+    first_id: int, last_id: int, db_: Database, tests: Catalog | None = None
+) -> list[models.OrderedLabTest]:
+    if tests is not None:
+        sql = """
+SELECT
+  * 
+FROM
+  PROE.OrderedTests
+WHERE
+  IsCancelled = 0
+  AND InvoiceId BETWEEN ? AND ?
+ORDER BY
+  InvoiceId,
+  Id
+        """
+        prepare = _test_resolver(tests)
+        return db_.fetch_models(
+            models.OrderedLabTest, sql, first_id, last_id, prepare=prepare
+        )
 
+    sql = """
+SELECT
+  ot.*,
+  tst.ShortName AS TestName,
+  tst.PerformingLabId AS LabId 
+FROM
+  PROE.OrderedTests AS ot
+  INNER JOIN [Catalog].LabTests AS tst ON ot.LabTestId = tst.Id 
+WHERE
+  ot.IsCancelled = 0 
+  AND ot.InvoiceId BETWEEN ? AND ?
+ORDER BY
+  ot.InvoiceId,
+  ot.Id
+    """
+    return db_.fetch_models(models.OrderedLabTest, sql, first_id, last_id)
 
-def insert_order(order: models.LabOrder, db_: Database) -> bool:
-    sql = "SELECT COUNT(*) AS C FROM PROE.PatientLabOrders WHERE SourceInvoiceId = ?"
-    if db_.fetch_scalar(sql, "C", order.InvoiceId) > 0:
-        utils.croak(f"Skipping #{order.InvoiceId}. already exists")
-        return False
-    # sql = 'EXEC PROE.SP_ShadowCreateNewLabOrderFull(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,)'
-    sql = """
-  INSERT INTO PROE.PatientLabOrders(
-     SourceInvoiceId,
-     OrderId,
-     OrderDateTime,
-     WorkflowStage,
-     LastModified,
-     IsCancelled,
-     ReferrerId,
-     DisallowReferral,
-     OrderingUserId,
-     WorkShiftId,
-     RequestingLabId,
-     Title,
-     FirstName,
-     LastName,
-     Sex,
-     Age,
-     DoB,
-     PhoneNumber,
-     EmailAddress,
-     EmailTestResults,
-     IsReferrerUnknown,
-     ReferrerCustomName,
-     OrderNotes,
-     WebAccessToken,
-     RegisteredMemberId,
-     SubOrderTrackingId,
-     IsExternalSubOrder,
-     MirrorFlag
-  )
-  VALUES
-   (
-     ?,
-     ?,
-     ?,
-     ?,
-     ?,
-     ?,
-     NULL, -- @refId,
-     0, -- @refDisallow,
-     ?,
-     ?, -- @shiftId,
-     NULL, -- @reqLabId,
-     ?,
-     ?,
-     ?,
-     ?,
-     ?,
-     ?,
-     ?,
-     NULL, -- @email,
-     0, -- @emailResult,
-     1, -- @refUnk,
-     ?, -- @refCustName,
-     NULL, -- @notes,
-     ?, -- @webToken,
-     NULL, -- @regMemberId,
-     NULL, -- @subTrackingId,
-     0, -- @subIsExternal,
-     0)    
+
+def range_items(
+    first_id: int, last_id: int, db_: Database, items: Catalog | None = None
+) -> list[models.OrderedBillableItem]:
+    if items is not None:
+        sql = """
+SELECT
+  * 
+FROM
+  PROE.OrderedBillableItems
+WHERE
+  IsCancelled = 0
+  AND InvoiceId BETWEEN ? AND ?
+ORDER BY
+  InvoiceId,
+  Id
+        """
+        prepare = _item_resolver(items)
+        return db_.fetch_models(
+            models.OrderedBillableItem, sql, first_id, last_id, prepare=prepare
+        )
+
+    sql = """
+SELECT
+  obi.*,
+  bi.Name AS BillableItemName 
+FROM
+  PROE.OrderedBillableItems AS obi
+  INNER JOIN [Catalog].BillableItems AS bi ON obi.BillableItemId = bi.Id 
+WHERE
+  obi.IsCancelled = 0
+  AND obi.InvoiceId BETWEEN ? AND ?
+ORDER BY
+  obi.InvoiceId,
+  obi.Id
     """
-    db_.execute(
+    return db_.fetch_models(models.OrderedBillableItem, sql, first_id, last_id)
+
+
+def range_bundles(
+    first_id: int, last_id: int, db_: Database
+) -> list[models.ResultBundle]:
+    sql = """
+SELECT
+  * 
+FROM
+  TestResults.ResultBundles 
+WHERE
+  InvoiceId BETWEEN ? AND ?
+  AND IsActive = 1
+ORDER BY
+  InvoiceId,
+  Id
+    """
+    return db_.fetch_models(models.ResultBundle, sql, first_id, last_id)
+
+
+def range_masters(first_id: int, last_id: int, db_: Database) -> list[models.Invoice]:
+    sql = "SELECT * FROM Finances.InvoiceMaster WHERE InvoiceId BETWEEN ? AND ?"
+    return db_.fetch_models(models.Invoice, sql, first_id, last_id)
+
+
+def range_primals(first_id: int, last_id: int, db_: Database) -> list[models.Invoice]:
+    sql = "SELECT * FROM Finances.InvoicePrimal WHERE InvoiceId BETWEEN ? AND ?"
+    return db_.fetch_models(models.Invoice, sql, first_id, last_id)
+
+
+def range_transactions(
+    first_id: int, last_id: int, db_: Database
+) -> list[models.InvoiceTransaction]:
+    # mirrors invoice_transactions(): a single transaction per invoice
+    sql = """
+SELECT
+  *
+FROM
+  (
+    SELECT
+      tx.*,
+      ROW_NUMBER() OVER (PARTITION BY tx.InvoiceId ORDER BY tx.Id) AS _rn_
+    FROM
+      Finances.InvoiceTransactions AS tx
+    WHERE
+      tx.InvoiceId BETWEEN ? AND ?
+  ) AS t
+WHERE
+  t._rn_ = 1
+ORDER BY
+  t.InvoiceId
+    """
+    return db_.fetch_models(models.InvoiceTransaction, sql, first_id, last_id)
+
+
+def insert_order(order: models.LabOrder, db_: Database) -> int | None:
+    # existence guard, INSERT and identity readback in a single round trip.
+    # OUTPUT ... INTO keeps this valid on tables with enabled triggers.
+    sql = """
+SET NOCOUNT ON;
+DECLARE @ids TABLE (InvoiceId BIGINT);
+INSERT INTO PROE.PatientLabOrders(
+   SourceInvoiceId,
+   OrderId,
+   OrderDateTime,
+   WorkflowStage,
+   LastModified,
+   IsCancelled,
+   ReferrerId,
+   DisallowReferral,
+   OrderingUserId,
+   WorkShiftId,
+   RequestingLabId,
+   Title,
+   FirstName,
+   LastName,
+   Sex,
+   Age,
+   DoB,
+   PhoneNumber,
+   EmailAddress,
+   EmailTestResults,
+   IsReferrerUnknown,
+   ReferrerCustomName,
+   OrderNotes,
+   WebAccessToken,
+   RegisteredMemberId,
+   SubOrderTrackingId,
+   IsExternalSubOrder,
+   MirrorFlag
+)
+OUTPUT INSERTED.InvoiceId INTO @ids
+SELECT
+   src.SourceInvoiceId,
+   ?,
+   ?,
+   ?,
+   ?,
+   ?,
+   NULL, -- @refId,
+   0, -- @refDisallow,
+   ?,
+   ?, -- @shiftId,
+   NULL, -- @reqLabId,
+   ?,
+   ?,
+   ?,
+   ?,
+   ?,
+   ?,
+   ?,
+   NULL, -- @email,
+   0, -- @emailResult,
+   1, -- @refUnk,
+   ?, -- @refCustName,
+   NULL, -- @notes,
+   ?, -- @webToken,
+   NULL, -- @regMemberId,
+   NULL, -- @subTrackingId,
+   0, -- @subIsExternal,
+   0
+FROM
+   (SELECT CAST(? AS BIGINT) AS SourceInvoiceId) AS src
+WHERE
+   NOT EXISTS (
+     SELECT 1
+     FROM PROE.PatientLabOrders AS ord WITH (UPDLOCK, HOLDLOCK)
+     WHERE ord.SourceInvoiceId = src.SourceInvoiceId
+   );
+SELECT InvoiceId FROM @ids;
+    """
+    invoice_id = db_.execute_returning(
         sql,
-        order.InvoiceId,
         order.OrderId,
         order.OrderDateTime,
         order.WorkflowStage,
@@ -252,9 +752,12 @@ def insert_order(order: models.LabOrder, db_: Database) -> bool:
         order.PhoneNumber,
         order.ReferrerCustomName,
         order.WebAccessToken,
+        order.InvoiceId,
     )
-    db_.commit()
-    return True
+    if invoice_id is None:
+        utils.croak(f"Skipping #{order.InvoiceId}. already exists")
+        return None
+    return int(invoice_id)
 
 
 def shadow_id_for_source_id(source_id: int, db_: Database) -> int | None:
@@ -262,6 +765,119 @@ def shadow_id_for_source_id(source_id: int, db_: Database) -> int | None:
     return db_.fetch_scalar(sql, "InvoiceId", source_id)
 
 
+def replicated_ids(
+    first_day: datetime.date, last_day: datetime.date, db_: Database
+) -> set[int]:
+    # every SourceInvoiceId already in the shadow for the days, in one query
+    sql = """
+SELECT SourceInvoiceId
+FROM PROE.PatientLabOrders
+WHERE OrderDateTime >= ? AND OrderDateTime < ? AND SourceInvoiceId IS NOT NULL
+    """
+    bounds = utils.day_bounds(first_day, last_day)
+    return set(db_.fetch_scalars(sql, "SourceInvoiceId", *bounds))
+
+
+def shadow_orders(
+    source_ids: list[int], db_: Database
+) -> dict[int, tuple[int, int | None]]:
+    # SourceInvoiceId -> (shadow InvoiceId, WorkShiftId) for those replicated
+    if not source_ids:
+        return {}
+
+    sql = """
+SELECT
+  ord.SourceInvoiceId,
+  ord.InvoiceId,
+  ord.WorkShiftId
+FROM
+  PROE.PatientLabOrders AS ord
+  INNER JOIN (
+    SELECT DISTINCT CAST(value AS BIGINT) AS Id FROM STRING_SPLIT(?, ',')
+  ) AS src ON ord.SourceInvoiceId = src.Id
+    """
+    rows = db_.fetch_all(sql, ",".join(map(str, source_ids)))
+    return {r["SourceInvoiceId"]: (r["InvoiceId"], r["WorkShiftId"]) for r in rows}
+
+
+def iter_shadow_orders(
+    db_: Database,
+    first_day: datetime.date | None = None,
+    last_day: datetime.date | None = None,
+) -> Iterator[tuple[int, int, datetime.date]]:
+    # (SourceInvoiceId, InvoiceId, order day) of every replicated order, or of
+    # those ordered on the given days
+    sql = """
+SELECT
+  SourceInvoiceId,
+  InvoiceId,
+  CAST(OrderDateTime AS DATE) AS OrderDate
+FROM
+  PROE.PatientLabOrders
+WHERE
+  SourceInvoiceId IS NOT NULL
+    """
+    params = []
+    if first_day:
+        sql += "  AND OrderDateTime >= ? AND OrderDateTime < ?\n"
+        params = utils.day_bounds(first_day, last_day)
+    for row in db_.iter_rows(sql + "ORDER BY SourceInvoiceId", *params):
+        yield row.SourceInvoiceId, row.InvoiceId, row.OrderDate
+
+
+def fetch_order(
+    invoice_id: int, db_: Database, referrers: Catalog | None = None
+) -> models.LabOrder | None:
+    sql = _orders_sql(referrers) + "WHERE ord.InvoiceId = ?"
+    prepare = _referrer_resolver(referrers)
+    orders = db_.fetch_models(models.LabOrder, sql, invoice_id, prepare=prepare)
+    return orders[0] if orders else None
+
+
+def update_order(invoice_id: int, order: models.LabOrder, db_: Database):
+    # OrderDateTime and WorkShiftId are the shadow's own; everything else
+    # insert_order() copied follows the source
+    sql = """
+UPDATE PROE.PatientLabOrders SET
+   WorkflowStage = ?
+  ,LastModified = ?
+  ,IsCancelled = ?
+  ,Title = ?
+  ,FirstName = ?
+  ,LastName = ?
+  ,Sex = ?
+  ,Age = ?
+  ,DoB = ?
+  ,PhoneNumber = ?
+  ,ReferrerCustomName = ?
+  ,WebAccessToken = ?
+WHERE
+  InvoiceId = ?
+    """
+    db_.execute(
+        sql,
+        order.WorkflowStage,
+        order.LastModified,
+        order.IsCancelled,
+        order.Title,
+        order.FirstName,
+        order.LastName,
+        order.Sex,
+        order.Age,
+        order.DoB,
+        order.PhoneNumber,
+        order.ReferrerCustomName,
+        order.WebAccessToken,
+        invoice_id,
+    )
+
+
+def delete_chain_rows(invoice_id: int, tables: list[str], db_: Database):
+    for table in CHAIN_TABLES:
+        if table in tables:
+            db_.execute(f"DELETE FROM {table} WHERE InvoiceId = ?", invoice_id)
+
+
 def insert_master(invoice_id: int, inv: models.Invoice, db_: Database):
     sql = """
 INSERT INTO Finances.InvoiceMaster(
@@ -388,9 +1004,8 @@ INSERT INTO Finances.[InvoiceTransactions](
   ,NULL -- PaymentReference - text
 )    
     """
-    for tx in transactions:
-        db_.execute(
-            sql,
+    params = [
+        (
             invoice_id,
             tx.PerformingUserId,
             shift_id,
@@ -401,41 +1016,101 @@ INSERT INTO Finances.[InvoiceTransactions](
             tx.NonCashAmount,
             tx.PaymentMethod,
         )
+        for tx in transactions
+    ]
+    db_.execute_many(sql, params)
 
 
 def get_shifts(dt: datetime.date, db_: Database) -> list[int]:
-    sql = "SELECT Id FROM Finances.WorkShifts WHERE CAST(StartTime AS DATE) = ? AND IsClosed = 0"
-    rows = db_.fetch_all(sql, dt)
+    sql = """
+SELECT Id
+FROM Finances.WorkShifts
+WHERE StartTime >= ? AND StartTime < ? AND IsClosed = 0
+    """
+    rows = db_.fetch_all(sql, *utils.day_bounds(dt))
     return [int(row["Id"]) for row in rows]
 
 
-def reconcile_shift(shift_id: int, close_shift: bool, db_: Database):
+def reconcile_shifts(shift_ids: list[int], close_shift: bool, db_: Database) -> int:
+    # one grouped aggregate over all requested shifts feeding one UPDATE ... FROM;
+    # shifts without transactions are reset to zero, as before
+    if not shift_ids:
+        return 0
+
     sql = """
-SELECT
-    SUM(tx.TxAmount) AS T 
-FROM
+WITH ids AS (
+  SELECT DISTINCT CAST(value AS INT) AS Id FROM STRING_SPLIT(?, ',')
+),
+totals AS (
+  SELECT
+    tx.WorkShiftId,
+    tx.TxType,
+    SUM(tx.TxAmount) AS T
+  FROM
     Finances.InvoiceTransactions AS tx
-    -- INNER JOIN Finances.WorkShifts AS ws ON tx.WorkShiftId = ws.Id
-WHERE
-    tx.WorkShiftId = ? 
-    AND tx.TxType = ?
+    INNER JOIN ids ON tx.WorkShiftId = ids.Id
+  WHERE
+    tx.TxType IN (?, ?, ?)
+  GROUP BY
+    tx.WorkShiftId,
+    tx.TxType
+),
+shifts AS (
+  SELECT
+    ids.Id,
+    COALESCE(SUM(CASE WHEN t.TxType = ? THEN t.T END), 0) AS Received,
+    COALESCE(SUM(CASE WHEN t.TxType = ? THEN t.T END), 0) AS Refunds,
+    COALESCE(SUM(CASE WHEN t.TxType = ? THEN t.T END), 0) AS Discounts
+  FROM
+    ids
+    LEFT JOIN totals AS t ON t.WorkShiftId = ids.Id
+  GROUP BY
+    ids.Id
+)
+UPDATE ws SET
+  ReceiveAmount = s.Received,
+  RefundAmount = s.Refunds,
+  DiscountAmount = s.Discounts,
+  FinalBalance = s.Received - s.Refunds,
+  IsClosed = ?
+FROM
+  Finances.WorkShifts AS ws
+  INNER JOIN shifts AS s ON ws.Id = s.Id
     """
-    received = db_.fetch_scalar(sql, "T", shift_id, TransactionType.Payment) or 0
-    refunds = db_.fetch_scalar(sql, "T", shift_id, TransactionType.Refund) or 0
-    discounts = db_.fetch_scalar(sql, "T", shift_id, TransactionType.CashDiscount) or 0
-
-    sql = "UPDATE Finances.WorkShifts SET ReceiveAmount = ?, RefundAmount = ?, DiscountAmount = ?, FinalBalance = ?, IsClosed = ? WHERE Id = ?"
-    db_.execute(
+    tx_types = (
+        TransactionType.Payment,
+        TransactionType.Refund,
+        TransactionType.CashDiscount,
+    )
+    return db_.execute(
         sql,
-        received,
-        refunds,
-        discounts,
-        received - refunds,
+        ",".join(str(int(sid)) for sid in shift_ids),
+        *tx_types,
+        *tx_types,
         1 if close_shift else 0,
-        shift_id,
     )
 
 
+def apply_shift_deltas(deltas: list[tuple[int, int, int, int]], db_: Database):
+    # (shift_id, received, refunds, discounts) added onto the stored totals
+    sql = """
+UPDATE Finances.WorkShifts SET
+  ReceiveAmount = ReceiveAmount + ?,
+  RefundAmount = RefundAmount + ?,
+  DiscountAmount = DiscountAmount + ?,
+  FinalBalance = FinalBalance + ?,
+  IsClosed = 0
+WHERE
+  Id = ?
+    """
+    params = [(r, rf, d, r - rf, sid) for sid, r, rf, d in deltas]
+    db_.execute_many(sql, params)
+
+
+def reconcile_shift(shift_id: int, close_shift: bool, db_: Database):
+    reconcile_shifts([shift_id], close_shift, db_)
+
+
 def insert_items(
     invoice_id: int, items: list[models.OrderedBillableItem], db_: Database
 ):
@@ -456,18 +1131,26 @@ INSERT INTO PROE.OrderedBillableItems(
   ,0  -- IsCancelled - bit
 )    
     """
-    for item in items:
-        db_.execute(
-            sql,
+    params = [
+        (
             invoice_id,
             item.BillableItemId,
             item.UnitPrice,
             item.Quantity,
             item.DateCreated,
         )
+        for item in items
+    ]
+    db_.execute_many(sql, params)
 
 
-def insert_tests(invoice_id: int, tests: list[models.OrderedLabTest], db_: Database):
+def insert_tests(
+    invoice_id: int,
+    tests: list[models.OrderedLabTest],
+    db_: Database,
+    bundle_ids: dict[int, int] | None = None,
+):
+    # bundle_ids maps source ResultBundleId -> shadow ResultBundleId
     sql = """
 INSERT INTO PROE.OrderedTests(
    InvoiceId
@@ -483,7 +1166,7 @@ INSERT INTO PROE.OrderedTests(
 ) VALUES (
    ?   -- InvoiceId - bigint
   ,?   -- LabTestId - smallint
-  ,NULL -- ResultBundleId - bigint
+  ,? -- ResultBundleId - bigint
   ,0  -- IsCancelled - bit
   ,?   -- UnitPrice - smallmoney
   ,?   -- WorkflowStage - tinyint
@@ -493,21 +1176,56 @@ INSERT INTO PROE.OrderedTests(
   ,NULL -- LabNo - varchar(12)
 )    
     """
-    for t in tests:
-        db_.execute(
-            sql,
+    params = [
+        (
             invoice_id,
             t.LabTestId,
+            bundle_ids.get(t.ResultBundleId) if bundle_ids else None,
             t.UnitPrice,
             t.WorkflowStage,
             t.DateCreated,
             t.LastModified,
         )
+        for t in tests
+    ]
+    db_.execute_many(sql, params)
 
 
-def insert_bundles(invoice_id: int, bundles: list[models.ResultBundle], db_: Database):
-    sql = """
-INSERT INTO TestResults.ResultBundles(
+# rows per MERGE: 10 parameters each, under SQL Server's 2100 limit
+BUNDLE_BATCH = 200
+
+
+def insert_bundles(
+    invoice_id: int, bundles: list[models.ResultBundle], db_: Database
+) -> dict[int, int]:
+    # returns source ResultBundleId -> shadow ResultBundleId. MERGE, unlike
+    # INSERT, can OUTPUT a source column next to the new identity, so the map
+    # does not depend on the order identities are assigned in.
+    bundles = sorted(bundles, key=lambda b: b.Id)
+    bundle_ids = {}
+    for i in range(0, len(bundles), BUNDLE_BATCH):
+        batch = bundles[i : i + BUNDLE_BATCH]
+        rows = ",\n  ".join(["(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"] * len(batch))
+        sql = f"""
+SET NOCOUNT ON;
+DECLARE @ids TABLE (SourceId BIGINT, Id BIGINT);
+MERGE TestResults.ResultBundles AS tgt
+USING (VALUES
+  {rows}
+) AS src (
+   SourceId
+  ,InvoiceId
+  ,LabId
+  ,TestResultType
+  ,DisplayTitle
+  ,ComponentLabTests
+  ,DateCreated
+  ,LastUpdated
+  ,TATRank
+  ,WorkflowStage
+)
+ON 1 = 0
+WHEN NOT MATCHED THEN INSERT (
    InvoiceId
   ,LabId
   ,ReportHeaderId
@@ -524,41 +1242,53 @@ INSERT INTO TestResults.ResultBundles(
   ,CreatingUserId
   ,ResultNotes
 ) VALUES (
-   ? -- InvoiceId - bigint
-  ,?   -- LabId - smallint
+   src.InvoiceId -- bigint
+  ,src.LabId -- smallint
   ,NULL -- ReportHeaderId - int
   ,1  -- IsActive - bit
-  ,?   -- TestResultType - tinyint
-  ,?  -- DisplayTitle - varchar(MAX)
-  ,? -- ComponentLabTests - varchar(MAX)
-  ,? -- DateCreated - smalldatetime
-  ,? -- LastUpdated - smalldatetime
-  ,?   -- TATRank - tinyint
-  ,?   -- WorkflowStage - tinyint
+  ,src.TestResultType -- tinyint
+  ,src.DisplayTitle -- varchar(MAX)
+  ,src.ComponentLabTests -- varchar(MAX)
+  ,src.DateCreated -- smalldatetime
+  ,src.LastUpdated -- smalldatetime
+  ,src.TATRank -- tinyint
+  ,src.WorkflowStage -- tinyint
   ,NULL -- FinalizingConsultantId - smallint
   ,NULL -- FinalizingConsultantName - varchar(160)
   ,NULL -- CreatingUserId - smallint
   ,NULL -- ResultNotes - varbinary(MAX)
-)    
-    """
-    for b in bundles:
-        db_.execute(
-            sql,
-            invoice_id,
-            b.LabId,
-            b.TestResultType,
-            b.DisplayTitle,
-            b.ComponentLabTests,
-            b.DateCreated,
-            b.LastUpdated,
-            b.TATRank,
-            b.WorkflowStage,
-        )
+)
+OUTPUT src.SourceId, INSERTED.Id INTO @ids;
+SELECT SourceId, Id FROM @ids;
+        """
+        params = [
+            value
+            for b in batch
+            for value in (
+                b.Id,
+                invoice_id,
+                b.LabId,
+                b.TestResultType,
+                b.DisplayTitle,
+                b.ComponentLabTests,
+                b.DateCreated,
+                b.LastUpdated,
+                b.TATRank,
+                b.WorkflowStage,
+            )
+        ]
+        for row in db_.execute_returning_all(sql, *params):
+            bundle_ids[row["SourceId"]] = row["Id"]
+    return bundle_ids
 
 
 def find_shift(user_id: int, dt: datetime.date, db_: Database) -> int | None:
-    sql = "SELECT * FROM Finances.[WorkShifts] WHERE CAST(StartTime AS DATE) = ? AND UserId = ?"
-    row = db_.fetch(sql, dt, user_id)
+    sql = """
+SELECT Id
+FROM Finances.WorkShifts
+WHERE StartTime >= ? AND StartTime < ? AND UserId = ?
+    """
+    row = db_.fetch(sql, *utils.day_bounds(dt), user_id)
     if row:
         return int(row["Id"])
     return None
@@ -566,6 +1296,8 @@ def find_shift(user_id: int, dt: datetime.date, db_: Database) -> int | None:
 
 def create_shift(user_id: int, dt: datetime.date, db_: Database) -> int:
     sql = """
+SET NOCOUNT ON;
+DECLARE @ids TABLE (Id INT);
 INSERT INTO Finances.WorkShifts(
    UserId
   ,IsClosed
@@ -581,7 +1313,9 @@ INSERT INTO Finances.WorkShifts(
   ,FinalBalance
   ,UserNotes
   ,NonCashAmount
-) VALUES (
+)
+OUTPUT INSERTED.Id INTO @ids
+VALUES (
    ?   -- UserId - smallint
   ,0  -- IsClosed - bit
   ,? -- StartTime - smalldatetime
@@ -596,17 +1330,264 @@ INSERT INTO Finances.WorkShifts(
   ,0   -- FinalBalance - money
   ,NULL -- UserNotes - varchar(MAX)
   ,0   -- NonCashAmount - money
-)    
+);
+SELECT Id FROM @ids;
     """
-    with db_.cursor() as cur:
-        cur.execute(sql, user_id, dt)
-        cur.execute("SELECT @@IDENTITY AS ID;")
-        return cur.fetchone()[0]
+    return int(db_.execute_returning(sql, user_id, dt))
 
-    return None
+
+# order-chain tables the change sync watches: (key column, modified column).
+# A NULL modified column is only covered by Change Tracking. Transactions are
+# left out: the shadow keeps only an invoice's first one.
+SYNC_TABLES = {
+    "PROE.PatientLabOrders": ("InvoiceId", "LastModified"),
+    "PROE.OrderedTests": ("Id", "LastModified"),
+    "PROE.OrderedBillableItems": ("Id", "LastModified"),
+    "TestResults.ResultBundles": ("Id", "LastUpdated"),
+    "Finances.InvoiceMaster": ("InvoiceId", None),
+    "Finances.InvoicePrimal": ("InvoiceId", None),
+}
+
+
+def _group_changes(rows: list[dict]) -> dict[int, set[str]]:
+    changes = defaultdict(set)
+    for row in rows:
+        changes[row["InvoiceId"]].add(row["TableName"])
+    return dict(changes)
+
+
+def change_tracking_version(db_: Database) -> int | None:
+    # NULL unless Change Tracking is enabled on the database
+    sql = "SELECT CHANGE_TRACKING_CURRENT_VERSION() AS V"
+    return db_.fetch_scalar(sql, "V")
+
+
+def change_tracked_tables(db_: Database) -> set[str]:
+    # the SYNC_TABLES with Change Tracking enabled; CT can be on for the
+    # database yet off for single tables
+    sql = " UNION ALL ".join(
+        f"SELECT '{t}' AS TableName FROM sys.change_tracking_tables "
+        f"WHERE object_id = OBJECT_ID('{t}')"
+        for t in SYNC_TABLES
+    )
+    return set(db_.fetch_scalars(sql, "TableName"))
+
+
+def change_tracking_valid(since: int, tables: set[str], db_: Database) -> bool:
+    # false once cleanup has dropped changes newer than `since` on any table
+    if not tables:
+        return True
+    sql = " UNION ALL ".join(
+        f"SELECT CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('{t}')) AS V"
+        for t in sorted(tables)
+    )
+    versions = db_.fetch_scalars(sql, "V")
+    return all(v is not None and v <= since for v in versions)
+
+
+def tracked_changes(
+    since: int, until: int, first_id: int, tables: set[str], db_: Database
+) -> dict[int, set[str]]:
+    # source InvoiceId -> changed tables, for versions (since, until] and from
+    # InvoiceId `first_id` on. Child rows deleted outright have no InvoiceId
+    # left to join to and are skipped.
+    parts = []
+    for table in sorted(tables):
+        key, _ = SYNC_TABLES[table]
+        if key == "InvoiceId":
+            parts.append(f"""
+SELECT ct.InvoiceId, '{table}' AS TableName
+FROM CHANGETABLE(CHANGES {table}, ?) AS ct
+WHERE ct.SYS_CHANGE_VERSION <= ? AND ct.InvoiceId >= ?""")
+        else:
+            parts.append(f"""
+SELECT t.InvoiceId, '{table}' AS TableName
+FROM CHANGETABLE(CHANGES {table}, ?) AS ct
+  INNER JOIN {table} AS t ON t.{key} = ct.{key}
+WHERE ct.SYS_CHANGE_VERSION <= ? AND t.InvoiceId >= ?""")
+    if not parts:
+        return {}
+    sql = "\nUNION\n".join(parts)
+    return _group_changes(db_.fetch_all(sql, *[since, until, first_id] * len(parts)))
+
+
+def modified_since(
+    since: datetime.datetime,
+    until: datetime.datetime,
+    first_id: int,
+    tables: set[str],
+    db_: Database,
+) -> dict[int, set[str]]:
+    # watermark fallback for tables without Change Tracking: rows modified in
+    # (since, until], from InvoiceId `first_id` on
+    parts = [
+        f"""
+SELECT InvoiceId, '{table}' AS TableName
+FROM {table}
+WHERE {column} > ? AND {column} <= ? AND InvoiceId >= ?"""
+        for table, (_, column) in sorted(SYNC_TABLES.items())
+        if table in tables
+    ]
+    if not parts:
+        return {}
+    sql = "\nUNION\n".join(parts)
+    return _group_changes(db_.fetch_all(sql, *[since, until, first_id] * len(parts)))
+
+
+def server_time(db_: Database) -> datetime.datetime:
+    return db_.fetch_scalar("SELECT SYSDATETIME() AS T", "T")
+
+
+def day_shifts(
+    first_day: datetime.date, last_day: datetime.date, db_: Database
+) -> dict[tuple[int, datetime.date], int]:
+    # (UserId, day) -> Id; where a user has several shifts on a day the
+    # oldest one wins
+    sql = """
+SELECT
+  Id,
+  UserId,
+  CAST(StartTime AS DATE) AS ShiftDate
+FROM
+  Finances.WorkShifts
+WHERE
+  StartTime >= ?
+  AND StartTime < ?
+ORDER BY
+  Id
+    """
+    shifts = {}
+    for row in db_.fetch_all(sql, *utils.day_bounds(first_day, last_day)):
+        shifts.setdefault((row["UserId"], row["ShiftDate"]), row["Id"])
+    return shifts
+
+
+def create_shifts(
+    user_ids: list[int], dt: datetime.date, db_: Database
+) -> dict[int, int]:
+    # create_shift() for many users in one statement; returns UserId -> Id
+    if not user_ids:
+        return {}
+
+    sql = """
+SET NOCOUNT ON;
+DECLARE @ids TABLE (Id INT, UserId INT);
+INSERT INTO Finances.WorkShifts(
+   UserId
+  ,IsClosed
+  ,StartTime
+  ,EndTime
+  ,LastUpdated
+  ,NumOrders
+  ,AdditionalBalance
+  ,ReceiveAmount
+  ,DiscountAmount
+  ,DiscountRebateAmount
+  ,RefundAmount
+  ,FinalBalance
+  ,UserNotes
+  ,NonCashAmount
+)
+OUTPUT INSERTED.Id, INSERTED.UserId INTO @ids
+SELECT
+   users.UserId
+  ,0
+  ,?
+  ,NULL
+  ,getdate()
+  ,0
+  ,0
+  ,0
+  ,0
+  ,0
+  ,0
+  ,0
+  ,NULL
+  ,0
+FROM
+  (SELECT DISTINCT CAST(value AS INT) AS UserId FROM STRING_SPLIT(?, ',')) AS users;
+SELECT Id, UserId FROM @ids;
+    """
+    rows = db_.execute_returning_all(sql, dt, ",".join(map(str, user_ids)))
+    return {row["UserId"]: row["Id"] for row in rows}
+
+
+def order_users(
+    first_day: datetime.date, last_day: datetime.date, db_: Database
+) -> dict[datetime.date, list[int]]:
+    # day -> the users who placed orders on it
+    sql = """
+SELECT DISTINCT
+  CAST(OrderDateTime AS DATE) AS OrderDate,
+  OrderingUserId
+FROM
+  PROE.PatientLabOrders
+WHERE
+  OrderDateTime >= ?
+  AND OrderDateTime < ?
+  AND OrderingUserId IS NOT NULL
+    """
+    users = defaultdict(list)
+    for row in db_.fetch_all(sql, *utils.day_bounds(first_day, last_day)):
+        users[row["OrderDate"]].append(row["OrderingUserId"])
+    return dict(users)
+
+
+def stage_shift_map(rows: list[tuple[datetime.date, int, int]], db_: Database):
+    # (day, UserId, shift Id) into the session's #ShiftMap
+    sql = """
+IF OBJECT_ID('tempdb..#ShiftMap') IS NOT NULL DROP TABLE #ShiftMap;
+CREATE TABLE #ShiftMap (
+  ShiftDate DATE NOT NULL,
+  UserId INT NOT NULL,
+  ShiftId INT NOT NULL,
+  PRIMARY KEY (ShiftDate, UserId)
+);
+    """
+    db_.execute(sql)
+    sql = "INSERT INTO #ShiftMap (ShiftDate, UserId, ShiftId) VALUES (?, ?, ?)"
+    sizes = [
+        (pyodbc.SQL_TYPE_DATE, 10, 0),
+        (pyodbc.SQL_INTEGER, 0, 0),
+        (pyodbc.SQL_INTEGER, 0, 0),
+    ]
+    db_.execute_many(sql, rows, sizes)
+
+
+def apply_shift_map(dt: datetime.date, db_: Database) -> tuple[int, int]:
+    # reassigns one day's orders, then their transactions, from #ShiftMap;
+    # orders without a mapped user keep their shift, as do their transactions
+    bounds = utils.day_bounds(dt)
+    sql = """
+UPDATE ord SET
+  WorkShiftId = m.ShiftId
+FROM
+  PROE.PatientLabOrders AS ord
+  INNER JOIN #ShiftMap AS m ON m.UserId = ord.OrderingUserId
+  AND m.ShiftDate = ?
+WHERE
+  ord.OrderDateTime >= ?
+  AND ord.OrderDateTime < ?
+    """
+    orders = db_.execute(sql, dt, *bounds)
+    sql = """
+UPDATE tx SET
+  WorkShiftId = ord.WorkShiftId
+FROM
+  Finances.InvoiceTransactions AS tx
+  INNER JOIN PROE.PatientLabOrders AS ord ON tx.InvoiceId = ord.InvoiceId
+  INNER JOIN #ShiftMap AS m ON m.UserId = ord.OrderingUserId
+  AND m.ShiftDate = ?
+WHERE
+  ord.OrderDateTime >= ?
+  AND ord.OrderDateTime < ?
+    """
+    transactions = db_.execute(sql, dt, *bounds)
+    return orders, transactions
 
 
 def purge_work_shifts(dt: datetime.date, db_: Database):
     db_.execute(
-        "DELETE FROM Finances.WorkShifts WHERE CAST( StartTime AS DATE ) = ?", dt
+        "DELETE FROM Finances.WorkShifts WHERE StartTime >= ? AND StartTime < ?",
+        *utils.day_bounds(dt),
     )
@@ -1,71 +1,364 @@
+import asyncio
+import contextlib
+import functools
 import itertools
-from typing import Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator
 
 import pyodbc
 
+from src import rows
+
 
 def create_dsn(config: dict[str, str]) -> str:
     return ";".join("=".join([k, v]) for k, v in config.items())
 
 
+class ConnectionPool:
+    """Bounded pool of warm pyodbc connections for a single DSN.
+
+    Idle connections older than `idle_timeout` seconds are closed instead of
+    being reused, and every connection is pinged before it is handed out.
+    Opening a new connection is retried `retries` times with a linear backoff.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        max_size: int = 4,
+        idle_timeout: float = 300,
+        retries: int = 3,
+        backoff: float = 2.0,
+    ):
+        self._dsn = dsn
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._idle: list[tuple[pyodbc.Connection, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @staticmethod
+    def is_alive(conn: pyodbc.Connection) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            return True
+        except pyodbc.Error:
+            return False
+
+    @staticmethod
+    def discard(conn: pyodbc.Connection):
+        try:
+            if not conn.closed:
+                conn.close()
+        except pyodbc.Error:
+            pass
+
+    def _open(self) -> pyodbc.Connection:
+        for attempt in range(1, self._retries + 1):
+            try:
+                return pyodbc.connect(self._dsn)
+            except pyodbc.Error:
+                if attempt == self._retries:
+                    raise
+                time.sleep(self._backoff * attempt)
+
+    def _take_idle(self) -> pyodbc.Connection | None:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                # LIFO keeps the most recently used connections warm
+                conn, released_at = self._idle.pop()
+
+            if time.monotonic() - released_at > self._idle_timeout:
+                self.discard(conn)
+            elif self.is_alive(conn):
+                return conn
+            else:
+                self.discard(conn)
+
+    def acquire(self, timeout: float | None = None) -> pyodbc.Connection:
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no free connection in pool (max {self._max_size})")
+        try:
+            return self._take_idle() or self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: pyodbc.Connection, broken: bool = False):
+        try:
+            if broken or conn.closed:
+                self.discard(conn)
+                return
+            try:
+                conn.rollback()
+            except pyodbc.Error:
+                self.discard(conn)
+                return
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dsn: str, **kwargs) -> ConnectionPool:
+    with _pools_lock:
+        if dsn not in _pools:
+            _pools[dsn] = ConnectionPool(dsn, **kwargs)
+        return _pools[dsn]
+
+
 class Database:
     _dsn: str | None = None
     _conn: pyodbc.Connection | None = None
+    _pool: ConnectionPool | None = None
+    _autocommit: bool = True
+    _tx_depth: int = 0
+
+    @staticmethod
+    def make(config: dict, autocommit: bool = True):
+        db = Database(create_dsn(config), autocommit=autocommit)
+        db.connect()
+        return db
 
     @staticmethod
-    def make(config: dict):
-        db = Database(create_dsn(config))
+    def pooled(config: dict, autocommit: bool = True, **pool_args):
+        dsn = create_dsn(config)
+        db = Database(dsn, get_pool(dsn, **pool_args), autocommit)
         db.connect()
         return db
 
-    def __init__(self, dsn: str):
+    def __init__(
+        self, dsn: str, pool: ConnectionPool | None = None, autocommit: bool = True
+    ):
+        # autocommit=False leaves every statement pending until commit()
         self._dsn = dsn
+        self._pool = pool
+        self._autocommit = autocommit
         # self._conn = pyodbc.connect(self._conn_string)
 
     def commit(self):
-        self._conn.commit()
+        # inside transaction() only the outermost block commits
+        if self._tx_depth == 0:
+            self._conn.commit()
+
+    def rollback(self):
+        if self._tx_depth == 0:
+            self._conn.rollback()
+
+    def _statement_done(self):
+        if self._autocommit:
+            self.commit()
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._tx_depth > 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Unit of work: the outermost block commits once, nested blocks are
+        savepoints that roll back on their own without aborting the outer one.
+        """
+        savepoint = f"sp{self._tx_depth}"
+        if self._tx_depth == 0:
+            # explicit BEGIN/SAVE/COMMIT need the driver out of implicit mode
+            self._conn.commit()
+            self._conn.autocommit = True
+            self._conn.execute("BEGIN TRANSACTION")
+        else:
+            self._conn.execute(f"SAVE TRANSACTION {savepoint}")
+        self._tx_depth += 1
+
+        try:
+            yield self
+        except BaseException:
+            self._tx_depth -= 1
+            try:
+                if self._tx_depth == 0:
+                    self._conn.execute("IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+                else:
+                    # a doomed transaction cannot roll back to a savepoint;
+                    # the outermost block will roll it back entirely
+                    self._conn.execute(
+                        f"IF XACT_STATE() = 1 ROLLBACK TRANSACTION {savepoint}"
+                    )
+            except pyodbc.Error:
+                pass
+            raise
+        else:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self._conn.execute("COMMIT TRANSACTION")
+        finally:
+            if self._tx_depth == 0 and not self._conn.closed:
+                self._conn.autocommit = False
 
     def cursor(self) -> pyodbc.Cursor:
         return self._conn.cursor()
 
+    @contextlib.contextmanager
+    def _cursor(self) -> Iterator[pyodbc.Cursor]:
+        # not `with conn.cursor()`: pyodbc's Cursor.__exit__ commits whenever
+        # the connection is out of autocommit, which would defeat
+        # autocommit=False. Commits happen in _statement_done() or commit().
+        cur = self._conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
     def connect(self):
-        self._conn = pyodbc.connect(self._dsn)
+        if self._conn is not None:
+            return
+        if self._pool:
+            self._conn = self._pool.acquire()
+        else:
+            self._conn = pyodbc.connect(self._dsn)
 
     def __enter__(self):
         self.connect()
         return self
 
-    def __exit__(self, *exc_info):
-        self.close()
+    def __exit__(self, exc_type, exc, tb):
+        # after a driver error the connection state is unknown, so it does
+        # not go back into the pool
+        self.close(isinstance(exc, pyodbc.Error))
 
     @staticmethod
     def column_names(cur: pyodbc.Cursor) -> list[str]:
         return [c[0] for c in cur.description]
 
     def execute(self, sql: str, *params: Any) -> int:
-        with self.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute(sql, params)
-            self.commit()
+            self._statement_done()
+            return cur.rowcount
+
+    def execute_many(
+        self, sql: str, params: list[tuple], sizes: list[tuple] | None = None
+    ) -> int:
+        # `sizes` skips the driver's parameter description, which fails for
+        # #temp tables, and pins the bound types, e.g. DATETIME precision
+        if not params:
+            return 0
+        with self._cursor() as cur:
+            cur.fast_executemany = True
+            if sizes:
+                cur.setinputsizes(sizes)
+            cur.executemany(sql, params)
+            self._statement_done()
             return cur.rowcount
 
+    def execute_returning(self, sql: str, *params: Any) -> Any:
+        # for INSERT ... OUTPUT batches; returns the first column of the first row
+        with self._cursor() as cur:
+            cur.execute(sql, params)
+            value = cur.fetchval()
+            self._statement_done()
+            return value
+
+    def execute_returning_all(self, sql: str, *params: Any) -> list[dict]:
+        # INSERT ... OUTPUT batch whose every output row is wanted
+        with self._cursor() as cur:
+            cur.execute(sql, params)
+            cols = self.column_names(cur)
+            rows = [dict(zip(cols, row)) for row in cur.fetchall()]
+            self._statement_done()
+            return rows
+
     def exec_sproc(self, sproc: str, *params: Any):
-        with self.cursor() as cur:
+        with self._cursor() as cur:
             sql = f"EXEC {sproc}"
             cur.execute(sql, params)
-            self.commit()
+            self._statement_done()
 
     def sproc(self, sproc_name: str, *params: Any):
         sproc_params = f"{sproc_name} " + ",".join(itertools.repeat("?", len(params)))
         return self.exec_sproc(sproc_params, *params)
 
     def fetch_all(self, sql: str, *params: Any) -> list[dict]:
-        with self.cursor() as cur:
+        with self._cursor() as cur:
             rows = cur.execute(sql, params).fetchall()
             cols = self.column_names(cur)
             return list(map(lambda o: dict(zip(cols, o)), rows))
 
+    def iter_rows(
+        self, sql: str, *params: Any, arraysize: int = 500
+    ) -> Iterator[pyodbc.Row]:
+        # keeps at most `arraysize` rows client-side; the connection stays busy
+        # until the generator is exhausted or closed
+        with self._cursor() as cur:
+            cur.arraysize = arraysize
+            cur.execute(sql, params)
+            while rows := cur.fetchmany(arraysize):
+                yield from rows
+
+    def fetch_iter(
+        self, sql: str, *params: Any, arraysize: int = 500
+    ) -> Iterator[dict]:
+        with self._cursor() as cur:
+            cur.arraysize = arraysize
+            cur.execute(sql, params)
+            cols = self.column_names(cur)
+            while rows := cur.fetchmany(arraysize):
+                for row in rows:
+                    yield dict(zip(cols, row))
+
+    def iter_models(
+        self,
+        model: type,
+        sql: str,
+        *params: Any,
+        prepare: Callable[[dict], dict | None] | None = None,
+        validate: bool = False,
+        arraysize: int = 500,
+    ) -> Iterator:
+        # prepare() may amend a row's field values or drop the row (None)
+        with self._cursor() as cur:
+            cur.arraysize = arraysize
+            cur.execute(sql, params)
+            factory = rows.factory_for(model, cur.description, validate)
+            while batch := cur.fetchmany(arraysize):
+                if prepare is None:
+                    yield from map(factory, batch)
+                    continue
+                for row in batch:
+                    values = prepare(factory.values(row))
+                    if values is not None:
+                        yield factory.build(values)
+
+    def fetch_models(self, model: type, sql: str, *params: Any, **kwargs) -> list:
+        return list(self.iter_models(model, sql, *params, **kwargs))
+
+    def fetch_model(
+        self, model: type, sql: str, *params: Any, validate: bool = False
+    ) -> Any | None:
+        with self._cursor() as cur:
+            cur.execute(sql, params)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return rows.factory_for(model, cur.description, validate)(row)
+
     def fetch(self, sql: str, *params: Any) -> dict | None:
-        with self.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute(sql, params)
             cols = self.column_names(cur)
             row: pyodbc.Row | None = cur.fetchone()
@@ -76,12 +369,16 @@ class Database:
             return None
 
     def fetch_val(self, sql: str, *params: Any) -> Any:
-        with self.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute(sql, params)
             return cur.fetchval()
 
-    def close(self):
-        if self._conn and not self._conn.closed:
+    def close(self, broken: bool = False):
+        if self._conn is None:
+            return
+        if self._pool:
+            self._pool.release(self._conn, broken)
+        elif not self._conn.closed:
             self._conn.close()
         self._conn = None
 
@@ -92,3 +389,99 @@ class Database:
     def fetch_scalars(self, sql: str, column: str, *params: Any) -> Any | None:
         rows = self.fetch_all(sql, *params)
         return list(map(lambda r: r.get(column), rows)) if rows else []
+
+
+class AsyncDatabase:
+    """asyncio facade over one `Database` connection.
+
+    Every call runs on a single dedicated worker thread, so statements on the
+    connection are serialised while the event loop stays free. Open several
+    facades to keep several requests in flight. Coroutines sharing a facade
+    also share its transaction. check_async.py exercises both against a fake
+    connection.
+    """
+
+    def __init__(self, db: Database):
+        self._db = db
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="adb")
+
+    @staticmethod
+    async def make(config: dict, **kwargs) -> "AsyncDatabase":
+        adb = AsyncDatabase(Database(create_dsn(config), **kwargs))
+        await adb.run(adb._db.connect)
+        return adb
+
+    @staticmethod
+    async def pooled(config: dict, autocommit: bool = True, **pool_args):
+        dsn = create_dsn(config)
+        pool = get_pool(dsn, **pool_args)
+        adb = AsyncDatabase(Database(dsn, pool, autocommit))
+        await adb.run(adb._db.connect)
+        return adb
+
+    @property
+    def db(self) -> Database:
+        return self._db
+
+    async def run(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    async def call(self, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+        # for dal-style functions that take the database as last positional arg
+        return await self.run(fn, *args, self._db, **kwargs)
+
+    async def execute(self, sql: str, *params: Any) -> int:
+        return await self.run(self._db.execute, sql, *params)
+
+    async def execute_many(
+        self, sql: str, params: list[tuple], sizes: list[tuple] | None = None
+    ) -> int:
+        return await self.run(self._db.execute_many, sql, params, sizes)
+
+    async def execute_returning(self, sql: str, *params: Any) -> Any:
+        return await self.run(self._db.execute_returning, sql, *params)
+
+    async def execute_returning_all(self, sql: str, *params: Any) -> list[dict]:
+        return await self.run(self._db.execute_returning_all, sql, *params)
+
+    async def fetch_all(self, sql: str, *params: Any) -> list[dict]:
+        return await self.run(self._db.fetch_all, sql, *params)
+
+    async def fetch(self, sql: str, *params: Any) -> dict | None:
+        return await self.run(self._db.fetch, sql, *params)
+
+    async def fetch_val(self, sql: str, *params: Any) -> Any:
+        return await self.run(self._db.fetch_val, sql, *params)
+
+    async def fetch_models(self, model: type, sql: str, *params: Any, **kwargs):
+        return await self.run(self._db.fetch_models, model, sql, *params, **kwargs)
+
+    async def fetch_model(self, model: type, sql: str, *params: Any, **kwargs):
+        return await self.run(self._db.fetch_model, model, sql, *params, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        cm = self._db.transaction()
+        await self.run(cm.__enter__)
+        try:
+            yield self
+        except BaseException as e:
+            if not await self.run(cm.__exit__, type(e), e, e.__traceback__):
+                raise
+        else:
+            await self.run(cm.__exit__, None, None, None)
+
+    async def close(self, broken: bool = False):
+        try:
+            await self.run(self._db.close, broken)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        await self.run(self._db.connect)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close(isinstance(exc, pyodbc.Error))
@@ -11,6 +11,19 @@ class LabTest(BaseModel):
     CanonicalName: str
     ListPrice: int
     LabName: str
+    PerformingLabId: int | None = None
+    IsActive: bool = True
+    LabIsActive: bool = True
+
+
+class BillableItem(BaseModel):
+    Id: int
+    Name: str
+
+
+class Referrer(BaseModel):
+    Id: int
+    FullName: str | None = None
 
 
 class Invoice(BaseModel):
@@ -0,0 +1,134 @@
+import decimal
+import enum
+import operator
+import threading
+import types
+import typing
+from typing import Any, Callable
+
+from pydantic import BaseModel
+
+# opt-in: route every row through full pydantic validation instead of the
+# trusted construction path
+STRICT = False
+
+_object_setattr = object.__setattr__
+
+
+def _base_type(annotation: Any) -> Any:
+    # `int | None` -> int
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+        args = [a for a in typing.get_args(annotation) if a is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def _whole(value: Any) -> int:
+    # money/smallmoney columns arrive as Decimal; a fractional amount is
+    # rejected, as pydantic would in strict mode, rather than truncated
+    number = int(value)
+    if number != value:
+        raise ValueError(f"{value!r} is not a whole number")
+    return number
+
+
+def _converter(annotation: Any, type_code: Any) -> Callable | None:
+    base = _base_type(annotation)
+    if isinstance(base, type) and issubclass(base, enum.Enum):
+        # a dict lookup is far cheaper than EnumType.__call__
+        return base._value2member_map_.__getitem__
+    if base is int and type_code in (decimal.Decimal, float):
+        return _whole
+    return None
+
+
+class RowFactory:
+    """Builds `model` instances straight from pyodbc rows of one query shape.
+
+    The column -> field map, type converters and field defaults are computed
+    once. Rows are trusted to match the SQL column types, so pydantic
+    validation is skipped unless `validate` (or `rows.STRICT`) is set.
+    """
+
+    __slots__ = (
+        "model",
+        "validate",
+        "_names",
+        "_getter",
+        "_converters",
+        "_defaults",
+    )
+
+    def __init__(self, model: type[BaseModel], description: tuple, validate: bool):
+        self.model = model
+        self.validate = validate
+
+        fields = model.model_fields
+        index = {}
+        for i, col in enumerate(description):
+            # the last duplicate column wins, as with dict(zip(cols, row))
+            if col[0] in fields:
+                index[col[0]] = i
+        self._names = tuple(index)
+        # itemgetter always returns a tuple when given more than one index
+        indices = tuple(index.values())
+        self._getter = (
+            operator.itemgetter(*indices)
+            if len(indices) > 1
+            else lambda row: tuple(row[i] for i in indices)
+        )
+        self._converters = tuple(
+            (name, conv)
+            for name, i in index.items()
+            if (conv := _converter(fields[name].annotation, description[i][1]))
+        )
+        # only defaults of fields the query does not return need merging
+        self._defaults = {
+            name: field.get_default(call_default_factory=True)
+            for name, field in fields.items()
+            if not field.is_required() and name not in index
+        }
+
+    def values(self, row) -> dict:
+        values = dict(zip(self._names, self._getter(row)))
+        for name, conv in self._converters:
+            value = values[name]
+            if value is not None:
+                values[name] = conv(value)
+        return values
+
+    def build(self, values: dict) -> BaseModel:
+        if self.validate or STRICT:
+            return self.model.model_validate(values)
+
+        # what BaseModel.model_construct() does, minus its per-call field walk
+        fields_set = set(values)
+        if self._defaults:
+            values = {**self._defaults, **values}
+        m = self.model.__new__(self.model)
+        _object_setattr(m, "__dict__", values)
+        _object_setattr(m, "__pydantic_fields_set__", fields_set)
+        _object_setattr(m, "__pydantic_extra__", None)
+        _object_setattr(m, "__pydantic_private__", None)
+        return m
+
+    def __call__(self, row) -> BaseModel:
+        return self.build(self.values(row))
+
+
+_factories: dict[tuple, RowFactory] = {}
+_factories_lock = threading.Lock()
+
+
+def factory_for(
+    model: type[BaseModel], description: tuple, validate: bool = False
+) -> RowFactory:
+    key = (model, tuple((c[0], c[1]) for c in description), validate)
+    factory = _factories.get(key)
+    if factory is None:
+        with _factories_lock:
+            factory = _factories.setdefault(
+                key, RowFactory(model, description, validate)
+            )
+    return factory
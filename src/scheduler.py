@@ -0,0 +1,68 @@
+import datetime
+import random
+
+
+class PollScheduler:
+    """Paces the live loop to the invoice traffic.
+
+    A cycle that found invoices is followed by the shortest wait. Idle cycles
+    start at `idle_wait` and double up to `max_wait`. Idle cycles outside
+    business hours sleep `off_hours_wait`. Every wait is spread by +/-
+    `jitter` so restarts do not poll in lockstep; an off-hours wait is then
+    cut short at the opening.
+    """
+
+    def __init__(
+        self,
+        min_wait: float,
+        idle_wait: float,
+        max_wait: float,
+        off_hours_wait: float,
+        start_hour: int,
+        end_hour: int,
+        jitter: float = 0.2,
+    ):
+        self.min_wait = min_wait
+        self.idle_wait = idle_wait
+        self.max_wait = max_wait
+        self.off_hours_wait = off_hours_wait
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.jitter = jitter
+        self.idle_cycles = 0
+        self.day: datetime.date | None = None
+
+    def days(self, today: datetime.date) -> list[datetime.date]:
+        # the first cycle after midnight polls the previous day one last time,
+        # so invoices that landed just before the rollover are not stranded
+        previous, self.day = self.day, today
+        if previous is not None and previous != today:
+            return [previous, today]
+        return [today]
+
+    def in_business_hours(self, now: datetime.datetime) -> bool:
+        return self.start_hour <= now.hour < self.end_hour
+
+    def next_wait(self, found: int, now: datetime.datetime) -> float:
+        if found:
+            self.idle_cycles = 0
+            wait = self.min_wait
+        else:
+            self.idle_cycles += 1
+            wait = min(self.max_wait, self.idle_wait * 2 ** (self.idle_cycles - 1))
+
+        # a late straggler keeps the normal pace; an idle night does not
+        until_open = None
+        if not found and not self.in_business_hours(now):
+            opening = now.replace(
+                hour=self.start_hour, minute=0, second=0, microsecond=0
+            )
+            if opening <= now:
+                opening += datetime.timedelta(days=1)
+            until_open = (opening - now).total_seconds()
+            wait = max(wait, min(self.off_hours_wait, until_open))
+
+        wait *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        if until_open is not None:
+            wait = min(wait, until_open)
+        return wait
@@ -0,0 +1,115 @@
+from collections import defaultdict
+
+from src.db import Database
+
+
+class Index:
+    """A nonclustered index one of the date-scoped dal queries relies on."""
+
+    __slots__ = ("target", "table", "name", "keys", "include")
+
+    def __init__(
+        self, target: str, table: str, name: str, keys: tuple, include: tuple = ()
+    ):
+        self.target = target
+        self.table = table
+        self.name = name
+        self.keys = keys
+        self.include = include
+
+    def ddl(self) -> str:
+        sql = (
+            f"CREATE NONCLUSTERED INDEX [{self.name}] ON {self.table} "
+            f"({', '.join(self.keys)})"
+        )
+        if self.include:
+            sql += f" INCLUDE ({', '.join(self.include)})"
+        return sql + ";"
+
+    def covered_by(self, keys: tuple, include: set) -> bool:
+        # an existing index with the same leading keys serves the same seeks
+        return keys[: len(self.keys)] == self.keys and set(self.include) <= (
+            include | set(keys)
+        )
+
+
+INDEXES = [
+    # fetch_invoice_page / fetch_invoices*: day range plus InvoiceId keyset
+    Index(
+        "src",
+        "PROE.PatientLabOrders",
+        "IX_PatientLabOrders_OrderDateTime",
+        ("OrderDateTime", "InvoiceId"),
+    ),
+    # iter_shadow_orders, order_id_span, purge_chunks, order_dates
+    Index(
+        "dst",
+        "PROE.PatientLabOrders",
+        "IX_PatientLabOrders_OrderDateTime",
+        ("OrderDateTime", "InvoiceId"),
+        ("SourceInvoiceId", "OrderingUserId"),
+    ),
+    # insert_order's UPDLOCK/HOLDLOCK probe, shadow_orders,
+    # shadow_id_for_source_id: without a key the probe range-locks a scan
+    # and concurrent backfill days block or deadlock each other
+    Index(
+        "dst",
+        "PROE.PatientLabOrders",
+        "IX_PatientLabOrders_SourceInvoiceId",
+        ("SourceInvoiceId",),
+    ),
+    # find_shift, day_shifts, get_shifts, purge_work_shifts
+    Index(
+        "dst",
+        "Finances.WorkShifts",
+        "IX_WorkShifts_StartTime",
+        ("StartTime", "UserId"),
+        ("IsClosed",),
+    ),
+]
+
+
+def indexes_for(target: str) -> list[Index]:
+    return [ix for ix in INDEXES if ix.target == target]
+
+
+def existing_indexes(table: str, db_: Database) -> list[tuple[tuple, set]]:
+    sql = """
+SELECT
+  i.index_id,
+  c.name AS ColumnName,
+  ic.key_ordinal,
+  ic.is_included_column
+FROM
+  sys.indexes AS i
+  INNER JOIN sys.index_columns AS ic ON ic.object_id = i.object_id
+  AND ic.index_id = i.index_id
+  INNER JOIN sys.columns AS c ON c.object_id = ic.object_id
+  AND c.column_id = ic.column_id
+WHERE
+  i.object_id = OBJECT_ID(?)
+  AND i.is_disabled = 0
+  AND i.is_hypothetical = 0
+ORDER BY
+  i.index_id,
+  ic.key_ordinal
+    """
+    keys = defaultdict(list)
+    include = defaultdict(set)
+    for row in db_.fetch_all(sql, table):
+        if row["is_included_column"]:
+            include[row["index_id"]].add(row["ColumnName"])
+        else:
+            keys[row["index_id"]].append(row["ColumnName"])
+    return [(tuple(keys[i]), include[i]) for i in keys]
+
+
+def missing_indexes(target: str, db_: Database) -> list[Index]:
+    missing = []
+    cache = {}
+    for ix in indexes_for(target):
+        if ix.table not in cache:
+            cache[ix.table] = existing_indexes(ix.table, db_)
+        if not any(ix.covered_by(k, inc) for k, inc in cache[ix.table]):
+            missing.append(ix)
+    return missing
@@ -0,0 +1,102 @@
+import datetime
+import threading
+
+from src import dal, models
+from src.db import Database
+from src.models import TransactionType
+
+
+class ShiftLedger:
+    """Running per-shift totals of the transactions this process inserted.
+
+    flush() turns them into delta updates of Finances.WorkShifts, so the cost
+    of keeping shifts current follows the number of new transactions rather
+    than the size of the shift. A full re-sum is only needed as a drift check.
+    """
+
+    def __init__(self):
+        # shift_id -> [received, refunds, discounts]
+        self._pending: dict[int, list] = {}
+        self.touched: set[int] = set()
+        self.day: datetime.date | None = None
+
+    def record(
+        self, shift_id: int | None, transactions: list[models.InvoiceTransaction]
+    ):
+        if shift_id is None:
+            return
+
+        totals = self._pending.setdefault(shift_id, [0, 0, 0])
+        for tx in transactions:
+            if tx.TxType == TransactionType.Payment:
+                totals[0] += tx.TxAmount
+            elif tx.TxType == TransactionType.Refund:
+                totals[1] += tx.TxAmount
+            elif tx.TxType == TransactionType.CashDiscount:
+                totals[2] += tx.TxAmount
+
+    def flush(self, db_: Database) -> int:
+        # call inside the transaction that inserted the recorded rows
+        deltas = [(sid, *totals) for sid, totals in sorted(self._pending.items())]
+        dal.apply_shift_deltas(deltas, db_)
+        self.touched.update(self._pending)
+        self._pending.clear()
+        return len(deltas)
+
+    def discard(self):
+        # the inserting transaction rolled back
+        self._pending.clear()
+
+    def check_drift(self, db_: Database) -> int:
+        # full re-sum of every shift this ledger has touched
+        return dal.reconcile_shifts(sorted(self.touched), False, db_)
+
+
+class ShiftRegistry:
+    """Work shift ids keyed by (user_id, day).
+
+    A day's existing shifts are loaded with one query the first time the day
+    is asked for, missing ones are created in one batched INSERT, and every
+    later lookup is served from memory.
+    """
+
+    def __init__(self):
+        self._shifts: dict[tuple[int, datetime.date], int] = {}
+        self._days: set[datetime.date] = set()
+        self._lock = threading.Lock()
+
+    def load(self, first_day: datetime.date, last_day: datetime.date, db_: Database):
+        with self._lock:
+            self._shifts.update(dal.day_shifts(first_day, last_day, db_))
+            day = first_day
+            while day <= last_day:
+                self._days.add(day)
+                day += datetime.timedelta(days=1)
+
+    def ensure(
+        self, user_ids: list[int | None], dt: datetime.date, db_: Database
+    ) -> dict[int, int]:
+        # user_id -> shift id for every given user, creating what is missing
+        if dt not in self._days:
+            self.load(dt, dt, db_)
+        with self._lock:
+            users = {uid for uid in user_ids if uid is not None}
+            missing = sorted(uid for uid in users if (uid, dt) not in self._shifts)
+            for uid, shift_id in dal.create_shifts(missing, dt, db_).items():
+                self._shifts[(uid, dt)] = shift_id
+            return {uid: self._shifts[(uid, dt)] for uid in users}
+
+    def get(self, user_id: int | None, dt: datetime.date, db_: Database) -> int | None:
+        if user_id is None:
+            return None
+        shift_id = self._shifts.get((user_id, dt))
+        if shift_id is None:
+            shift_id = self.ensure([user_id], dt, db_)[user_id]
+        return shift_id
+
+    def forget(self, dt: datetime.date):
+        # the day's shifts were purged or rolled back on the server
+        with self._lock:
+            self._days.discard(dt)
+            for key in [k for k in self._shifts if k[1] == dt]:
+                del self._shifts[key]
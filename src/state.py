@@ -0,0 +1,176 @@
+import datetime
+import sqlite3
+import threading
+from collections.abc import Iterable
+
+from src import dal
+from src.db import Database
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermarks (
+  day TEXT PRIMARY KEY,
+  last_source_id INTEGER NOT NULL,
+  updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoices (
+  source_id INTEGER PRIMARY KEY,
+  shadow_id INTEGER NOT NULL,
+  day TEXT NOT NULL,
+  replicated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_invoices_day ON invoices (day);
+CREATE TABLE IF NOT EXISTS sync_baseline (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  ct_version INTEGER,
+  server_time TEXT,
+  updated_at TEXT NOT NULL
+);
+"""
+
+REBUILD_BATCH = 5_000
+
+
+class StateStore:
+    """Replication progress kept in a local SQLite file.
+
+    Holds one watermark (highest source InvoiceId handled) per order day,
+    the status of every replicated source invoice and the change sync's
+    baseline. The loop resumes from it after a restart, and answers "is this
+    invoice replicated" from it, without probing the destination. A day it
+    has never seen is seeded from the shadow once; rebuild() recreates the
+    whole store when the file is lost.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.executescript(SCHEMA)
+
+    def watermark(self, dt: datetime.date) -> int | None:
+        # None means the day was never seen; 0 means nothing replicated yet
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_source_id FROM watermarks WHERE day = ?",
+                (dt.isoformat(),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, dt: datetime.date, last_source_id: int):
+        with self._lock, self._conn:
+            self._set_watermark(dt.isoformat(), last_source_id)
+
+    def _set_watermark(self, day: str, last_source_id: int):
+        self._conn.execute(
+            """
+INSERT INTO watermarks (day, last_source_id, updated_at) VALUES (?, ?, ?)
+ON CONFLICT (day) DO UPDATE SET
+  last_source_id = MAX(last_source_id, excluded.last_source_id),
+  updated_at = excluded.updated_at
+            """,
+            (day, last_source_id, _now()),
+        )
+
+    def record(
+        self,
+        dt: datetime.date,
+        replicated: list[tuple[int, int]],
+        last_source_id: int | None = None,
+    ):
+        # replicated: (source InvoiceId, shadow InvoiceId). Call only once the
+        # destination has committed them.
+        day = dt.isoformat()
+        now = _now()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?)",
+                [(src, shadow, day, now) for src, shadow in replicated],
+            )
+            ids = [src for src, _ in replicated]
+            if last_source_id is not None:
+                ids.append(last_source_id)
+            if ids:
+                self._set_watermark(day, max(ids))
+
+    def sync_baseline(self) -> tuple[int | None, datetime.datetime | None]:
+        # (Change Tracking version, source server time) the change sync has
+        # applied everything up to; (None, None) before the first poll
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT ct_version, server_time FROM sync_baseline WHERE id = 1"
+            ).fetchone()
+        if not row:
+            return None, None
+        since = datetime.datetime.fromisoformat(row[1]) if row[1] else None
+        return row[0], since
+
+    def set_sync_baseline(self, version: int | None, since: datetime.datetime | None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+INSERT OR REPLACE INTO sync_baseline (id, ct_version, server_time, updated_at)
+VALUES (1, ?, ?, ?)
+                """,
+                (version, since.isoformat() if since else None, _now()),
+            )
+
+    def replicated(self, dt: datetime.date) -> set[int] | None:
+        # source InvoiceIds recorded for the day; None if the day was never seen
+        day = dt.isoformat()
+        with self._lock:
+            if not self._conn.execute(
+                "SELECT 1 FROM watermarks WHERE day = ?", (day,)
+            ).fetchone():
+                return None
+            rows = self._conn.execute(
+                "SELECT source_id FROM invoices WHERE day = ?", (day,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def seed(self, dt: datetime.date, db_: Database) -> int:
+        # loads a day the store has never seen from the shadow; returns its
+        # watermark
+        rows = [(src, shadow) for src, shadow, _ in dal.iter_shadow_orders(db_, dt, dt)]
+        self.record(dt, rows, 0)
+        return self.watermark(dt)
+
+    def rebuild(self, db_: Database) -> int:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM invoices")
+            self._conn.execute("DELETE FROM watermarks")
+            count = 0
+            for batch in _batched(dal.iter_shadow_orders(db_), REBUILD_BATCH):
+                now = _now()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?)",
+                    [(src, shadow, day.isoformat(), now) for src, shadow, day in batch],
+                )
+                count += len(batch)
+            self._conn.execute(
+                """
+INSERT INTO watermarks (day, last_source_id, updated_at)
+SELECT day, MAX(source_id), ? FROM invoices GROUP BY day
+                """,
+                (_now(),),
+            )
+        return count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def _batched(rows: Iterable, size: int) -> Iterable[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,135 @@
+import datetime
+
+from src import dal
+from src.catalogs import OrderContext, ReferenceData
+from src.db import Database
+from src.state import StateStore
+from src.utils import croak
+
+ORDERS = "PROE.PatientLabOrders"
+TESTS = "PROE.OrderedTests"
+ITEMS = "PROE.OrderedBillableItems"
+BUNDLES = "TestResults.ResultBundles"
+MASTER = "Finances.InvoiceMaster"
+PRIMAL = "Finances.InvoicePrimal"
+
+
+# smalldatetime modified columns round to the minute, so each watermark poll
+# reaches back this far; a change seen twice is just rewritten twice
+WATERMARK_OVERLAP = datetime.timedelta(minutes=1)
+
+
+class ChangeSync:
+    """Carries source changes to invoices that are already in the shadow.
+
+    Changed keys come from SQL Server Change Tracking for the tables that have
+    it enabled, and from a modified-time watermark for the rest. Each cycle
+    calls begin() before its scan; the poll then covers the changes from the
+    baseline up to that mark, re-hydrates each changed invoice and rewrites
+    just the shadow tables that changed. Invoices the scan inserted after the
+    mark (`fresh`) already hold everything up to it and are skipped; their
+    later edits fall into the next window. The baseline is kept in the
+    StateStore, so a restart resumes where the last applied poll ended. The
+    very first poll only sets it.
+
+    Payments are out of scope: the shadow keeps only an invoice's first
+    transaction, so Finances.InvoiceTransactions is not watched and payments
+    added later are never carried over.
+    """
+
+    def __init__(self, state: StateStore | None = None):
+        self.state = state
+        self.tracked: set[str] | None = None
+        self.version, self.since = state.sync_baseline() if state else (None, None)
+        self.mark: tuple[int | None, datetime.datetime] | None = None
+        self.fresh: set[int] = set()
+
+    def _detect(self, db_: Database):
+        if self.tracked is not None:
+            return
+        self.tracked = dal.change_tracked_tables(db_)
+        watched = self.tracked | {t for t, (_, c) in dal.SYNC_TABLES.items() if c}
+        croak(f"Change sync: {len(self.tracked)} tables via change tracking")
+        for table in sorted(set(dal.SYNC_TABLES) - watched):
+            croak(f"WARNING: {table} has no change tracking, changes are not synced")
+
+    def begin(self, db_: Database):
+        self._detect(db_)
+        version = dal.change_tracking_version(db_) if self.tracked else None
+        self.mark = (version, dal.server_time(db_))
+        self.fresh.clear()
+
+    def poll(self, first_id: int, db_: Database) -> dict[int, set[str]]:
+        version, now = self.mark
+        changes = {}
+        if self.tracked and self.version is not None and version is not None:
+            if dal.change_tracking_valid(self.version, self.tracked, db_):
+                changes = dal.tracked_changes(
+                    self.version, version, first_id, self.tracked, db_
+                )
+            else:
+                croak(f"Change tracking cleaned up past v{self.version}")
+
+        stamped = {t for t, (_, c) in dal.SYNC_TABLES.items() if c} - self.tracked
+        if stamped and self.since is not None:
+            since = self.since - WATERMARK_OVERLAP
+            for source_id, tables in dal.modified_since(
+                since, now, first_id, stamped, db_
+            ).items():
+                changes.setdefault(source_id, set()).update(tables)
+
+        for source_id in self.fresh:
+            changes.pop(source_id, None)
+        return changes
+
+    def run(
+        self,
+        first_day: datetime.date,
+        db_: Database,
+        dest_db: Database,
+        refs: ReferenceData | None = None,
+    ):
+        if self.mark is None:
+            self.begin(db_)
+        first_id, _ = dal.order_id_span(first_day, first_day, db_)
+        changes = self.poll(first_id, db_) if first_id is not None else {}
+        # invoices not replicated yet are left to the InvoiceId > last_id scan
+        shadows = dal.shadow_orders(sorted(changes), dest_db)
+        for source_id, (invoice_id, _) in shadows.items():
+            order = dal.fetch_order(source_id, db_, refs.referrers if refs else None)
+            if order is None:
+                continue
+
+            ctx = OrderContext(order)
+            ctx.scan(db_, refs)
+            tables = changes[source_id]
+            croak(f"Sync #{source_id} -> {invoice_id}: {', '.join(sorted(tables))}")
+            with dest_db.transaction():
+                apply_changes(invoice_id, ctx, tables, dest_db)
+
+        # only now that the window is applied does the baseline move past it
+        self.version, self.since = self.mark
+        self.mark = None
+        if self.state:
+            self.state.set_sync_baseline(self.version, self.since)
+
+
+def apply_changes(invoice_id: int, ctx: OrderContext, tables: set[str], db_: Database):
+    # shadow child rows carry new identities, so a changed table is replaced
+    # for the invoice as a whole. Tests and bundles are replaced together:
+    # the source -> shadow bundle map only comes out of insert_bundles().
+    if BUNDLES in tables or TESTS in tables:
+        tables = tables | {BUNDLES, TESTS}
+    dal.delete_chain_rows(invoice_id, list(tables), db_)
+
+    if ORDERS in tables:
+        dal.update_order(invoice_id, ctx.order, db_)
+    if MASTER in tables:
+        dal.insert_master(invoice_id, ctx.master, db_)
+    if PRIMAL in tables:
+        dal.insert_primal(invoice_id, ctx.primal, db_)
+    if ITEMS in tables:
+        dal.insert_items(invoice_id, ctx.items, db_)
+    if BUNDLES in tables:
+        bundle_ids = dal.insert_bundles(invoice_id, ctx.bundles, db_)
+        dal.insert_tests(invoice_id, ctx.tests, db_, bundle_ids)
@@ -1,5 +1,7 @@
+import random
 import sys
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from typing import Any
 
 from prettyprinter import cpprint
@@ -25,6 +27,50 @@ def croak(msg: str):
     print(f"[{fmt}] {msg}")
 
 
+def report_purge(purged: int, last_id: int):
+    # progress callback for dal.purge_chains
+    croak(f"Purged {purged} invoices, up to #{last_id}")
+
+
+def choose_cutoff(
+    nets: list[tuple[int, Decimal]], max_net: int
+) -> tuple[int | None, Decimal]:
+    # the last InvoiceId whose running net total stays under the barrier.
+    # `nets` prices the whole day from InvoiceMaster alone, so only the
+    # prefix up to the cutoff needs hydrating afterwards
+    cutoff = None
+    net_total = 0
+    for invoice_id, net in nets:
+        if net_total + net >= max_net:
+            break
+        net_total += net
+        cutoff = invoice_id
+    return cutoff, net_total
+
+
+def day_bounds(first: date, last: date | None = None) -> tuple[date, date]:
+    # half-open [first, last + 1 day) range; `col >= ? AND col < ?` stays
+    # sargable where CAST(col AS DATE) = ? forces a scan
+    return first, (last or first) + timedelta(days=1)
+
+
+def spread_times(
+    dt: date, count: int, start_hour: int, end_hour: int
+) -> list[datetime]:
+    # `count` evenly spaced timestamps over dt's business hours, in whole
+    # seconds; the first and last fall a few random minutes inside them
+    sod = datetime.combine(dt, datetime.min.time()) + timedelta(
+        hours=start_hour, minutes=random.randint(3, 12)
+    )
+    eod = datetime.combine(dt, datetime.min.time()) + timedelta(
+        hours=end_hour - 1, minutes=random.randint(45, 57)
+    )
+    if count == 0:
+        return []
+    step = (eod - sod) / count
+    return [(sod + step * i).replace(microsecond=0) for i in range(count)]
+
+
 def get_config() -> dict:
     with open("config.yml", "r") as file:
         return yaml.safe_load(file)
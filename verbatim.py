@@ -1,92 +1,383 @@
+import argparse
+import asyncio
+import itertools
+import queue
+import threading
 import time
-from datetime import date
+from datetime import date, datetime, timedelta
 
 import arrow
+import pyodbc
 import yaml
 
-from src import db, dal, utils
+from src import aiodal, dal, utils
+from src.db import AsyncDatabase, Database
 from src.utils import croak
-from src.catalogs import OrderContext
+from src.catalogs import OrderContext, ReferenceData
+from src.scheduler import PollScheduler
+from src.shifts import ShiftLedger, ShiftRegistry
+from src.state import StateStore
+from src.sync import ChangeSync
 
 config = utils.get_config()
 DB_SRC = config["db"]["src"]
 DB_DEST = config["db"]["dst"]
 WAIT_SECONDS = int(config["main"]["wait_seconds"])
+POLL = config["main"].get("poll", {})
+# small pages so that even a short burst overlaps reads and writes
+PAGE_SIZE = 25
+PIPELINE_DEPTH = 4
+# source connections the asyncio loop keeps hydration requests in flight on
+ASYNC_SOURCES = 3
+DRIFT_CHECK_CYCLES = int(config["main"].get("drift_check_cycles", 20))
+SYNC_CHANGES = bool(config["main"].get("sync_changes", True))
+REFS = ReferenceData()
+LEDGER = ShiftLedger()
+SHIFTS = ShiftRegistry()
+STATE = StateStore(config["state"]["path"])
+SYNC = ChangeSync(STATE)
+# source InvoiceIds in the shadow, per order day; loaded once per day from
+# the state store and kept current as cycles commit
+REPLICATED: dict[date, set[int]] = {}
+SCHEDULER = PollScheduler(
+    min_wait=float(POLL.get("min_seconds", 5)),
+    idle_wait=WAIT_SECONDS,
+    max_wait=float(POLL.get("max_seconds", 120)),
+    off_hours_wait=float(POLL.get("off_hours_seconds", 900)),
+    start_hour=int(config["main"]["business_hours"]["start"]),
+    end_hour=int(config["main"]["business_hours"]["end"]),
+    jitter=float(POLL.get("jitter", 0.2)),
+)
 
 
-def dest_last_invoice_id(dt: date) -> int | None:
-    with db.Database.make(DB_DEST) as db_:
-        return dal.last_src_invoice_id(dt, db_)
+def dest_last_invoice_id(dt: date, db_: Database) -> int | None:
+    # answered locally; only a day the state store has never seen costs a
+    # destination read, which seeds the store
+    last_id = STATE.watermark(dt)
+    if last_id is None:
+        last_id = STATE.seed(dt, db_)
+    return last_id or None
 
 
-def scan_insert_orders(dt: date, last_id: int | None) -> list[OrderContext]:
-    with db.Database.make(DB_SRC) as db_:
-        shift_ids = []
-        test_cat = dal.get_test_catalog(db_)
-        # staff = dal.get_staff_catalog(db_src)
-        if last_id is not None and last_id > 0:
-            invoices = dal.fetch_invoices_after(dt, last_id, db_)
-        else:
-            invoices = dal.fetch_invoices(dt, db_)
-        croak(f"Found {len(invoices)} invoices for {dt}, Last: {last_id}")
-        contexts = []
-        for inv in invoices:
-            croak(f"Scanning #{inv.InvoiceId}")
-            ctx = OrderContext(inv)
-            ctx.scan(db_)
-            # ctx.sanitize_tests(test_cat)
-            contexts.append(ctx)
-            shift_id = dest_insert_chain(ctx)
-            if shift_id:
-                shift_ids.append(shift_id)
+def replicated(dt: date, db_: Database) -> set[int]:
+    if dt not in REPLICATED:
+        # only today and a day still being caught up on are ever polled
+        for day in [d for d in REPLICATED if d < dt - timedelta(days=1)]:
+            del REPLICATED[day]
+        ids = STATE.replicated(dt)
+        REPLICATED[dt] = ids if ids is not None else dal.replicated_ids(dt, dt, db_)
+    return REPLICATED[dt]
 
-        for shift_id in sorted(set(shift_ids)):
-            dal.reconcile_shift(shift_id, False, db_)
 
-        return contexts
+def _put(pages: queue.Queue, item, stop: threading.Event) -> bool:
+    # blocks while the consumer is behind, but gives up once it has failed
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
 
-def dest_insert_chain(order: OrderContext) -> int | None:
+def src_hydrate_pages(
+    dt: date,
+    last_id: int | None,
+    db_: Database,
+    pages: queue.Queue,
+    stop: threading.Event,
+):
+    try:
+        REFS.refresh(db_)
+        invoices = dal.iter_invoice_pages(
+            dt, db_, last_id, PAGE_SIZE, referrers=REFS.referrers
+        )
+        for page in invoices:
+            if not _put(pages, OrderContext.scan_all(page, db_, REFS), stop):
+                return
+        _put(pages, None, stop)
+    except BaseException as e:
+        _put(pages, e, stop)
+
+
+class DayScan:
+    """One cycle's scan of one order day, shared by both loops.
+
+    insert() writes a page of chains inside the caller's destination
+    transaction; committed() or failed() does the bookkeeping once that
+    transaction has committed or rolled back.
+    """
+
+    def __init__(self, dt: date, last_id: int | None, db_: Database):
+        self.dt = dt
+        self.last_id = last_id
+        self.done = replicated(dt, db_)
+        self.count = 0
+        self.inserted: list[tuple[int, int]] = []
+        self.last_seen: int | None = None
+
+    def insert(self, contexts: list[OrderContext], db_: Database):
+        for ctx in contexts:
+            croak(f"Scanning #{ctx.order.InvoiceId}")
+            # ctx.sanitize_tests(REFS.active_tests)
+            self.count += 1
+            self.last_seen = ctx.order.InvoiceId
+            if self.last_seen in self.done:
+                continue
+            invoice_id = dest_insert_chain(ctx, db_)
+            if invoice_id:
+                LEDGER.record(ctx.order.WorkShiftId, ctx.transactions)
+                self.inserted.append((ctx.order.InvoiceId, invoice_id))
+
+    def failed(self):
+        LEDGER.discard()
+        # shifts created in the rolled-back transaction are gone again
+        SHIFTS.forget(self.dt)
+
+    def committed(self) -> int:
+        croak(f"Found {self.count} invoices for {self.dt}, Last: {self.last_id}")
+        source_ids = [src for src, _ in self.inserted]
+        self.done.update(source_ids)
+        STATE.record(self.dt, self.inserted, self.last_seen)
+        if SYNC_CHANGES:
+            # hydrated after the change poll's mark, which they are current to
+            SYNC.fresh.update(source_ids)
+        return self.count
+
+
+def scan_insert_orders(
+    dt: date, last_id: int | None, db_: Database, dest_db: Database
+) -> int:
+    # the source connection hydrates page N+1 on a producer thread while this
+    # thread writes page N to the destination; the bounded queue applies
+    # backpressure and its FIFO order keeps the source InvoiceId order
+    # before the producer starts: a failure here must not leave it running
+    scan = DayScan(dt, last_id, dest_db)
+    pages = queue.Queue(maxsize=PIPELINE_DEPTH)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=src_hydrate_pages, args=(dt, last_id, db_, pages, stop), daemon=True
+    )
+    producer.start()
+
+    try:
+        # a cycle's chains and their shift deltas commit together; a crash
+        # leaves last_id untouched
+        with dest_db.transaction():
+            while (contexts := pages.get()) is not None:
+                if isinstance(contexts, BaseException):
+                    raise contexts
+                scan.insert(contexts, dest_db)
+            # shifts live on the destination, never on the production source
+            LEDGER.flush(dest_db)
+    except BaseException:
+        scan.failed()
+        raise
+    finally:
+        stop.set()
+        # the producer must be done with the source connection before the
+        # caller hands it back to the pool
+        producer.join()
+    return scan.committed()
+
+
+def dest_insert_chain(order: OrderContext, db_: Database) -> int | None:
+    # returns the shadow InvoiceId, or None when the order already exists
     croak(f"INSERT #{order.order.InvoiceId} - {order.order.OrderId}")
-    with db.Database.make(DB_DEST) as db_:
-        shift_id = dal.find_shift(order.order.OrderingUserId, arrow.now().date(), db_)
-        if not shift_id:
-            shift_id = dal.create_shift(
-                order.order.OrderingUserId, arrow.now().date(), db_
-            )
-
-        order.order.WorkShiftId = shift_id
-        if not dal.insert_order(order.order, db_):
+    day = order.order.OrderDateTime.date()
+    shift_id = SHIFTS.get(order.order.OrderingUserId, day, db_)
+
+    order.order.WorkShiftId = shift_id
+    with db_.transaction():
+        invoice_id = dal.insert_order(order.order, db_)
+        if not invoice_id:
             return None
 
-        invoice_id = dal.shadow_id_for_source_id(order.order.InvoiceId, db_)
         croak(f"Src: {order.order.InvoiceId} -> Dest: {invoice_id}")
         dal.insert_master(invoice_id, order.master, db_)
         dal.insert_primal(invoice_id, order.primal, db_)
         dal.insert_transactions(invoice_id, order.transactions, shift_id, db_)
         dal.insert_items(invoice_id, order.items, db_)
-        dal.insert_tests(invoice_id, order.tests, db_)
-        dal.insert_bundles(invoice_id, order.bundles, db_)
-        db_.commit()
-        return shift_id
+        bundle_ids = dal.insert_bundles(invoice_id, order.bundles, db_)
+        dal.insert_tests(invoice_id, order.tests, db_, bundle_ids)
+    return invoice_id
 
 
 def reconcile(dt: date):
-    with db.Database.make(DB_DEST) as db_:
-        shift_ids = dal.get_shifts(dt, db_)
-        for sid in shift_ids:
-            dal.reconcile_shift(sid, True, db_)
-
-
-def looper(wait: int):
-    while True:
-        dt = arrow.now().date()
-        last_id = dest_last_invoice_id(dt)
-        scan_insert_orders(dt, last_id)
-        croak(f"Zzzzzz {wait}s...")
+    with Database.pooled(DB_DEST) as db_:
+        dal.reconcile_shifts(dal.get_shifts(dt, db_), True, db_)
+
+
+def sync_changes(dt: date, db_: Database, dest_db: Database):
+    # updates to invoices replicated earlier today; the InvoiceId scan above
+    # only ever sees new ones
+    if not SYNC_CHANGES:
+        return
+
+    SYNC.run(dt, db_, dest_db, REFS)
+
+
+def check_drift(cycle: int, dt: date, db_: Database):
+    # deltas keep shifts current; a periodic full re-sum catches anything
+    # written to them outside this process
+    if cycle % DRIFT_CHECK_CYCLES == 0:
+        croak(f"Drift check of {len(LEDGER.touched)} shifts")
+        LEDGER.check_drift(db_)
+    if LEDGER.day != dt:
+        LEDGER.touched.clear()
+        LEDGER.day = dt
+
+
+def close_day(dt: date, db_: Database):
+    # the day rolled over: its catch-up poll is done, close its shifts
+    croak(f"Closing shifts of {dt}")
+    dal.reconcile_shifts(dal.get_shifts(dt, db_), True, db_)
+
+
+def begin_cycle(src_db: Database):
+    if SYNC_CHANGES:
+        # the change poll stops where this cycle's scan starts
+        SYNC.begin(src_db)
+
+
+def end_cycle(cycle: int, days: list[date], src_db: Database, dest_db: Database):
+    for dt in days[:-1]:
+        close_day(dt, dest_db)
+    sync_changes(days[-1], src_db, dest_db)
+    check_drift(cycle, days[-1], dest_db)
+
+
+def cycle_failed(e: pyodbc.Error, days: list[date]):
+    croak(f"Cycle failed, retrying with fresh connections: {e!r}")
+    # poll the same days again, including a pending midnight catch-up
+    SCHEDULER.day = days[0]
+
+
+def looper():
+    for cycle in itertools.count(1):
+        days = SCHEDULER.days(arrow.now().date())
+        found = 0
+        # pooled connections stay open between cycles; only a dead or
+        # long-idle connection costs a fresh login
+        try:
+            with (
+                Database.pooled(DB_SRC) as src_db,
+                Database.pooled(DB_DEST) as dest_db,
+            ):
+                begin_cycle(src_db)
+                for dt in days:
+                    last_id = dest_last_invoice_id(dt, dest_db)
+                    found += scan_insert_orders(dt, last_id, src_db, dest_db)
+                end_cycle(cycle, days, src_db, dest_db)
+        except pyodbc.Error as e:
+            # Database.__exit__ has already discarded both connections
+            cycle_failed(e, days)
+        wait = SCHEDULER.next_wait(found, datetime.now())
+        croak(f"Zzzzzz {wait:.0f}s...")
         time.sleep(wait)
 
 
+async def ascan_insert_orders(
+    dt: date,
+    last_id: int | None,
+    src_dbs: list[AsyncDatabase],
+    dest_db: AsyncDatabase,
+) -> int:
+    # pages are listed on the first source connection and hydrated as tasks
+    # spread over all of them; the queue holds those tasks in InvoiceId order
+    await aiodal.refresh_reference_data(REFS, src_dbs[0])
+    hydrated = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+
+    async def produce():
+        try:
+            after_id = last_id or 0
+            while True:
+                page = await aiodal.fetch_invoice_page(
+                    dt, after_id, PAGE_SIZE, src_dbs[0], REFS.referrers
+                )
+                if page:
+                    task = asyncio.create_task(aiodal.scan_all(page, src_dbs, REFS))
+                    await hydrated.put(task)
+                if len(page) < PAGE_SIZE:
+                    break
+                after_id = page[-1].InvoiceId
+            await hydrated.put(None)
+        except Exception as e:
+            await hydrated.put(e)
+
+    scan = await dest_db.run(DayScan, dt, last_id, dest_db.db)
+    producer = asyncio.create_task(produce())
+    try:
+        async with dest_db.transaction():
+            while (task := await hydrated.get()) is not None:
+                if isinstance(task, Exception):
+                    raise task
+                # the page's chains go in on the destination's own thread, as
+                # savepoints of the transaction above
+                await dest_db.run(scan.insert, await task, dest_db.db)
+            await dest_db.run(LEDGER.flush, dest_db.db)
+    except BaseException:
+        scan.failed()
+        raise
+    finally:
+        producer.cancel()
+        while not hydrated.empty():
+            if isinstance(task := hydrated.get_nowait(), asyncio.Task):
+                task.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+    return scan.committed()
+
+
+async def alooper():
+    adbs: list[AsyncDatabase] = []
+    try:
+        for cycle in itertools.count(1):
+            days = SCHEDULER.days(arrow.now().date())
+            found = 0
+            try:
+                if not adbs:
+                    for config_ in [*[DB_SRC] * ASYNC_SOURCES, DB_DEST]:
+                        adbs.append(await AsyncDatabase.pooled(config_))
+                *src_dbs, dest_db = adbs
+                await src_dbs[0].run(begin_cycle, src_dbs[0].db)
+                for dt in days:
+                    last_id = await dest_db.run(dest_last_invoice_id, dt, dest_db.db)
+                    found += await ascan_insert_orders(dt, last_id, src_dbs, dest_db)
+                # the source connection is idle here, so it can ride along on
+                # the destination's thread
+                await dest_db.run(end_cycle, cycle, days, src_dbs[0].db, dest_db.db)
+            except pyodbc.Error as e:
+                # the failed connection is unknown; none goes back to the pool
+                while adbs:
+                    await adbs.pop().close(broken=True)
+                cycle_failed(e, days)
+            wait = SCHEDULER.next_wait(found, datetime.now())
+            croak(f"Zzzzzz {wait:.0f}s...")
+            await asyncio.sleep(wait)
+    finally:
+        for adb in adbs:
+            await adb.close()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replicate new invoices live")
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true", help="run the asyncio loop"
+    )
+    parser.add_argument(
+        "--rebuild-state",
+        action="store_true",
+        help="rebuild the local state store from the destination and exit",
+    )
+    args = parser.parse_args()
+
+    if args.rebuild_state:
+        with Database.make(DB_DEST) as db_:
+            croak(f"Rebuilt state of {STATE.rebuild(db_)} invoices")
+        raise SystemExit(0)
+
     reconcile(arrow.now().date())
-    looper(WAIT_SECONDS)
+    if args.use_async:
+        asyncio.run(alooper())
+    else:
+        looper()